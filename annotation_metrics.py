@@ -0,0 +1,173 @@
+#!/bin/python3
+"""
+APLOSE annotation campaign analysis of the APLOSE-Simple Metrics notebook, vectorised to handle millions of annotations
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+
+PARSER = argparse.ArgumentParser(description='Script that converts annotation campaign results for the APLOSE-Simple Metrics notebook')
+SUBPARSERS = PARSER.add_subparsers(dest='command', required=True)
+DCLDE_PARSER = SUBPARSERS.add_parser('dclde', help='Matches DCLDE annotations to the small wav files of a dataset, in the campaign results format')
+DCLDE_PARSER.add_argument('annotations', help='DCLDE annotations CSV file (deployment, site, species, start, end, annotation)')
+DCLDE_PARSER.add_argument('dataset_files', help='dataset_files.csv of the small wav files')
+DCLDE_PARSER.add_argument('--duration', type=float, default=None, help='Duration (in s) of the small wav files, annotation end times are clipped to it (default each file duration)')
+DCLDE_PARSER.add_argument('--output', '-o', type=str, default='dclde_campaign.csv', help='Output .csv or .parquet file')
+PARQUET_PARSER = SUBPARSERS.add_parser('parquet', help='Converts a campaign results CSV file to Parquet by chunks')
+PARQUET_PARSER.add_argument('csv_file', help='Campaign results CSV file')
+PARQUET_PARSER.add_argument('parquet_file', help='Output Parquet file')
+PARQUET_PARSER.add_argument('--chunksize', type=int, default=10**6, help='Number of CSV rows read at once')
+PARQUET_PARSER.add_argument('--blacklist', nargs='*', default=[], help='Annotators whose annotations are dropped')
+LABELS_PARSER = SUBPARSERS.add_parser('labels', help='Prints the number of labels of every annotator')
+LABELS_PARSER.add_argument('results', help='Campaign results .csv or .parquet file')
+LABELS_PARSER.add_argument('--blacklist', nargs='*', default=[], help='Annotators left out')
+
+# Columns of campaign results, in the order of the collaborative campaign CSV files
+CAMPAIGN_COLUMNS = ['filename', 'start_time', 'end_time', 'annotation', 'annotator']
+CAMPAIGN_DTYPES = {'filename': str, 'start_time': float, 'end_time': float, 'annotation': str, 'annotator': str}
+DCLDE_COLUMNS = ['Deployment', 'Site', 'Specie', 'start', 'end', 'annotation']
+DCLDE_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+DCLDE_ANNOTATOR = 'DCLDE_exp'
+DATASET_FILES_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def pyarrow_modules():
+    """Returns the pyarrow and pyarrow.parquet modules, needed for Parquet files only"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError('Parquet files need the pyarrow package (pip install pyarrow)') from error
+    return pyarrow, pyarrow.parquet
+
+def read_dclde_annotations(csv_file):
+    """Returns the start, end and annotation columns of a DCLDE annotations CSV file, dates being parsed as a whole column"""
+    annotations = pd.read_csv(csv_file, header=0, names=DCLDE_COLUMNS, usecols=['start', 'end', 'annotation'])
+    for column in ['start', 'end']:
+        annotations[column] = pd.to_datetime(annotations[column], format=DCLDE_DATE_FORMAT)
+    return annotations
+
+def read_dataset_files(csv_file):
+    """Returns the filename, audio_start and audio_end columns of a dataset_files.csv file, with or without quoted dates"""
+    files = pd.read_csv(csv_file, skipinitialspace=True, usecols=['filename', 'audio_start', 'audio_end'])
+    for column in ['audio_start', 'audio_end']:
+        files[column] = pd.to_datetime(files[column].str.strip('"'), format=DATASET_FILES_DATE_FORMAT)
+    return files
+
+def match_files(starts, ends, files, duration=None):
+    """Returns the filename, start_time and end_time (in s, relative to the file start) of the file containing each annotation start
+
+    Files are sorted by audio_start once and every annotation is located with a binary search, files should not overlap.
+    End times are clipped to duration, or to the file duration when None. Annotations out of every file get NaN.
+    """
+    order = np.argsort(files['audio_start'].to_numpy(dtype='datetime64[ns]'), kind='stable')
+    file_starts = files['audio_start'].to_numpy(dtype='datetime64[ns]')[order]
+    file_ends = files['audio_end'].to_numpy(dtype='datetime64[ns]')[order]
+    filenames = files['filename'].to_numpy()[order]
+    starts = np.asarray(starts, dtype='datetime64[ns]')
+    ends = np.asarray(ends, dtype='datetime64[ns]')
+
+    indexes = np.searchsorted(file_starts, starts, side='right') - 1
+    matched = indexes >= 0
+    indexes = np.maximum(indexes, 0)
+    matched &= starts < file_ends[indexes]
+
+    second = np.timedelta64(1, 's')
+    start_times = (starts - file_starts[indexes]) / second
+    limits = (file_ends[indexes] - file_starts[indexes]) / second if duration is None else duration
+    end_times = np.minimum((ends - file_starts[indexes]) / second, limits)
+    return pd.DataFrame({
+        'filename': np.where(matched, filenames[indexes], None),
+        'start_time': np.where(matched, start_times, np.nan),
+        'end_time': np.where(matched, end_times, np.nan)
+    })
+
+def dclde_campaign(annotations, files, duration=None, annotator=DCLDE_ANNOTATOR):
+    """Returns DCLDE annotations matched to the small wav files in the campaign results format, labels being 40-Hz or Dcall"""
+    campaign = match_files(annotations['start'], annotations['end'], files, duration)
+    campaign['annotation'] = np.where(annotations['annotation'].to_numpy() == '40Hz', '40-Hz', 'Dcall')
+    campaign['annotator'] = annotator
+    return campaign[CAMPAIGN_COLUMNS]
+
+def campaign_to_parquet(csv_file, parquet_file, chunksize=10**6, blacklist=(), columns=CAMPAIGN_COLUMNS):
+    """Converts the columns of a campaign results CSV file to Parquet chunksize rows at a time, dropping blacklist annotators
+
+    Returns the number of written rows. The Parquet file is only complete once renamed from its temporary name.
+    """
+    pyarrow, parquet = pyarrow_modules()
+    dtypes = {column: dtype for column, dtype in CAMPAIGN_DTYPES.items() if column in columns}
+    temp_file = f"{parquet_file}.{os.getpid()}.tmp"
+    writer = None
+    nb_rows = 0
+    try:
+        for chunk in pd.read_csv(csv_file, usecols=columns, dtype=dtypes, chunksize=chunksize):
+            if blacklist:
+                chunk = chunk[~chunk['annotator'].isin(blacklist)]
+            table = pyarrow.Table.from_pandas(chunk[columns], preserve_index=False)
+            if writer is None:
+                writer = parquet.ParquetWriter(temp_file, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            nb_rows += len(chunk)
+        if writer is None:
+            writer = parquet.ParquetWriter(temp_file, pyarrow.Table.from_pandas(pd.DataFrame(columns=columns).astype(dtypes), preserve_index=False).schema)
+        writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    os.replace(temp_file, parquet_file)
+    return nb_rows
+
+def read_campaign(path, blacklist=(), columns=CAMPAIGN_COLUMNS):
+    """Returns the columns of campaign results from a .parquet or .csv file, without blacklist annotators"""
+    if path.endswith('.parquet'):
+        pyarrow_modules()
+        results = pd.read_parquet(path, columns=columns)
+    else:
+        results = pd.read_csv(path, usecols=columns, dtype={column: dtype for column, dtype in CAMPAIGN_DTYPES.items() if column in columns})
+    if blacklist:
+        results = results[~results['annotator'].isin(blacklist)]
+    return results
+
+def write_campaign(results, path):
+    """Writes campaign results to a .parquet or .csv file"""
+    if path.endswith('.parquet'):
+        pyarrow_modules()
+        results.to_parquet(path, index=False)
+    else:
+        results.to_csv(path, index=False, header=True)
+
+def label_counts(results, blacklist=()):
+    """Returns the (annotator, annotation) indexed nb_labels frame of the number of labels of every annotator"""
+    if blacklist:
+        results = results[~results['annotator'].isin(blacklist)]
+    return results.groupby(['annotator', 'annotation'], sort=True).size().to_frame('nb_labels')
+
+def task_durations(time_results, blacklist=()):
+    """Returns the annotator indexed durations of every annotated file, summed over the times an annotator labelled it"""
+    if blacklist:
+        time_results = time_results[~time_results['annotator'].isin(blacklist)]
+    durations = time_results.groupby(['filename', 'annotator'], sort=True)['duration'].sum()
+    return durations.reset_index(level=0, drop=True).to_frame()
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+
+    if args.command == 'dclde':
+        campaign = dclde_campaign(read_dclde_annotations(args.annotations), read_dataset_files(args.dataset_files), args.duration)
+        write_campaign(campaign, args.output)
+        print(f"Matched {campaign['filename'].notna().sum()}/{len(campaign)} annotations to files in {args.output}")
+    elif args.command == 'parquet':
+        nb_rows = campaign_to_parquet(args.csv_file, args.parquet_file, args.chunksize, args.blacklist)
+        print(f"Wrote {nb_rows} annotations to {args.parquet_file}")
+    else:
+        print(label_counts(read_campaign(args.results), args.blacklist).unstack().describe())
+
+if __name__ == '__main__':
+    main()
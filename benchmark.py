@@ -0,0 +1,276 @@
+#!/bin/python3
+"""
+Benchmarks of gen_spectro.py and gen_seed.py on synthetic data, with baseline comparison
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import soundfile
+
+import gen_spectro
+
+
+PARSER = argparse.ArgumentParser(description='Script that benchmarks spectro and seed generation on synthetic data')
+SUBPARSERS = PARSER.add_subparsers(dest='command', required=True)
+RUN_PARSER = SUBPARSERS.add_parser('run', help='Runs the benchmarks and saves their results as JSON')
+RUN_PARSER.add_argument('--output', '-o', type=str, default='benchmark_results.json', help='JSON results filepath')
+RUN_PARSER.add_argument('--data-folder', type=str, default=os.path.join(tempfile.gettempdir(), 'ode_benchmark'), help='Folder where synthetic wav files and seed folders are generated and kept between runs')
+RUN_PARSER.add_argument('--durations', nargs='+', default=['10m', '1h', '6h'], help='Durations of the synthetic wav files (like 90s, 10m or 6h)')
+RUN_PARSER.add_argument('--sample-rates', nargs='+', type=int, default=[32000, 96000], help='Sample rates (in Hz) of the synthetic wav files')
+RUN_PARSER.add_argument('--tile-levels', type=int, default=6, help='gen_tiles is benchmarked for tile levels 2 up to this one, level 1 being gen_spectro')
+RUN_PARSER.add_argument('--spectro-args', type=str, default='--nfft 2048 --win_size 512 --overlap 90 --color_val_range=-90:0', help='gen_spectro.py arguments of the gen_spectro and gen_tiles benchmarks')
+RUN_PARSER.add_argument('--butter-order', type=int, default=5, help='Order of the benchmarked Butterworth highpass filter')
+RUN_PARSER.add_argument('--butter-cutoff', type=float, default=10, help='Cutoff (in Hz) of the benchmarked Butterworth highpass filter')
+RUN_PARSER.add_argument('--seeds', nargs='+', default=['10000:10', '2000:100', '200:1000'], help='Synthetic seed folders as FILES:USERS, USERS=0 using gen_seed default users')
+RUN_PARSER.add_argument('--repeat', type=int, default=1, help='Runs of each benchmark, the fastest one is kept')
+RUN_PARSER.add_argument('--only', type=str, default=None, help='Regex selecting the benchmarks to run by name')
+COMPARE_PARSER = SUBPARSERS.add_parser('compare', help='Compares results to a baseline and exits with 1 on regressions')
+COMPARE_PARSER.add_argument('baseline', help='Baseline JSON results filepath')
+COMPARE_PARSER.add_argument('results', help='New JSON results filepath')
+COMPARE_PARSER.add_argument('--threshold', type=float, default=10, help='Time or memory increase (in percent) flagged as regression')
+COMPARE_PARSER.add_argument('--min-time', type=float, default=0.05, help='Time increases below this duration (in s) are ignored')
+COMPARE_PARSER.add_argument('--min-memory', type=float, default=8, help='Memory increases below this size (in MB) are ignored')
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+# Synthetic wav files are written by blocks of this duration (in s)
+WAV_BLOCK = 60
+SYNTH_START = '2019-06-01 00:00:00'
+
+
+def parse_duration(string):
+    """Returns the duration in seconds of a string like 90s, 10m or 6h"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smh])', string)
+    if match is None:
+        raise ValueError(f"Duration should be a number followed by s, m or h, not {string}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+def synthetic_wav(data_folder, duration, sample_rate):
+    """Returns the filepath of the PCM16 wav file of duration (in s) and sample_rate, generating it if needed
+
+    The signal is low level white noise with a slow frequency sweep and periodic clicks, so every
+    spectrogram tile has some content, and is seeded to be the same on every machine.
+    """
+    nb_samples = int(duration * sample_rate)
+    wav_file = os.path.join(data_folder, f"synth_{int(duration)}s_{sample_rate}.wav")
+    if os.path.exists(wav_file) and soundfile.info(wav_file).frames == nb_samples:
+        return wav_file
+
+    print(f"Generating {wav_file}", flush=True)
+    rng = np.random.default_rng(sample_rate)
+    sweep_period = 600
+    temp_file = wav_file + '.tmp.wav'
+    with soundfile.SoundFile(temp_file, 'w', sample_rate, 1, 'PCM_16') as sound_file:
+        block_size = WAV_BLOCK * sample_rate
+        for start in range(0, nb_samples, block_size):
+            times = np.arange(start, min(nb_samples, start + block_size)) / sample_rate
+            # Linear sweep from 0 to a quarter of the sample rate every sweep_period seconds
+            phase = np.pi * sample_rate / 4 * (times % sweep_period) ** 2 / sweep_period
+            block = 0.01 * rng.standard_normal(len(times)) + 0.1 * np.sin(phase)
+            block[(times % 10) < 0.005] += 0.5
+            sound_file.write(block)
+    os.replace(temp_file, wav_file)
+    return wav_file
+
+def synthetic_seed(data_folder, nb_files, nb_users):
+    """Returns the path of a seed folder with nb_files audio files and nb_users users, generating it if needed
+
+    Audio files are empty since gen_seed only reads their size, nb_users 0 means no users.csv.
+    """
+    seed_folder = Path(data_folder) / f"seed_{nb_files}f_{nb_users}u"
+    if (seed_folder / 'annotation_campaigns.csv').exists():
+        return seed_folder
+
+    print(f"Generating {seed_folder}", flush=True)
+    seed_folder.mkdir(parents=True, exist_ok=True)
+    datasets = [f"Synthetic dataset {i}" for i in range(max(1, nb_files // 1000))]
+    with open(seed_folder / 'datasets.csv', 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(['name', 'files_type', 'start_date', 'end_date', 'dataset_type_name', 'dataset_type_description',
+                         'location_name', 'location_desc', 'location_lat', 'location_lon', 'audio_channel_count', 'audio_sample_rate_khz',
+                         'audio_total_samples', 'audio_sample_bits', 'audio_start', 'audio_end'])
+        for dataset in datasets:
+            writer.writerow([dataset, '.wav', '2019-06-01', '2019-07-01', 'Coastal', 'Coastal audio', 'Brest', 'Rade de Brest',
+                             '48.35', '-4.5', '1', '32', '', '16', SYNTH_START, ''])
+    with open(seed_folder / 'dataset_files.csv', 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(['dataset_name', 'filename', 'audio_start', 'audio_end', 'audio_sample_rate_khz'])
+        for i in range(nb_files):
+            filename = f"synth_{i:06d}.wav"
+            start = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1559347200 + 600 * i))
+            end = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1559347200 + 600 * i + 599))
+            writer.writerow([datasets[i % len(datasets)], filename, start, end, '32.0'])
+            (seed_folder / filename).touch()
+    with open(seed_folder / 'annotation_campaigns.csv', 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(['name', 'desc', 'instructions_url', 'start', 'end', 'annotation_set', 'dataset_name'])
+        for i, dataset in enumerate(datasets):
+            writer.writerow([f"Campaign {i}", f"Synthetic campaign {i}", '', '2019-06-01', '2019-12-31', f"Whistle{i},Click{i},Noise{i}", dataset])
+    if nb_users:
+        with open(seed_folder / 'users.csv', 'w', newline='') as csv_f:
+            writer = csv.writer(csv_f)
+            writer.writerow(['user', 'password'])
+            for i in range(nb_users):
+                writer.writerow([f"user{i}@test.ode", f"password{i}"])
+    return seed_folder
+
+def spectro_args(args, wav_file, output, tile_levels):
+    """Returns the gen_spectro parsed args of a gen_spectro or gen_tiles benchmark"""
+    return gen_spectro.PARSER.parse_args([wav_file, output, '--tile-levels', str(tile_levels)] + args.spectro_args.split())
+
+def make_cases(args):
+    """Returns the list of (name, function name, arguments, estimated memory) of the benchmarks"""
+    os.makedirs(args.data_folder, exist_ok=True)
+    cases = []
+    for duration in args.durations:
+        for sample_rate in args.sample_rates:
+            label = f"{duration}_{sample_rate // 1000}k"
+            nb_samples = int(parse_duration(duration) * sample_rate)
+            wav_args = (args.data_folder, parse_duration(duration), sample_rate)
+            generator = gen_spectro.make_spectro_generator(spectro_args(args, '', '', 1))
+            spectro_memory = generator.memory_estimate(nb_samples)
+            cases.append((f"gen_spectro/{label}", 'bench_spectro', (wav_args, 1), spectro_memory))
+            for tile_levels in range(2, args.tile_levels + 1):
+                cases.append((f"gen_tiles/{label}/l{tile_levels}", 'bench_spectro', (wav_args, tile_levels), spectro_memory))
+            cases.append((f"butter/{label}", 'bench_butter', (wav_args,), 5 * 8 * nb_samples))
+    for seed in args.seeds:
+        nb_files, nb_users = (int(count) for count in seed.split(':'))
+        cases.append((f"gen_seed/{nb_files}f_{nb_users}u", 'bench_seed', (nb_files, nb_users), 0))
+    if args.only:
+        cases = [case for case in cases if re.search(args.only, case[0])]
+    return cases
+
+def current_rss():
+    """Returns the current resident memory (in bytes) of the process"""
+    with open('/proc/self/statm', 'r') as statm_f:
+        return int(statm_f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def peak_rss():
+    """Returns the peak resident memory (in bytes) of the process"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_spectro(args, wav_args, tile_levels):
+    """Times gen_spectro.py on a synthetic wav file, audio decoding included"""
+    wav_file = synthetic_wav(*wav_args)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, 'spectro.png')
+        spectro_arguments = spectro_args(args, wav_file, output, tile_levels)
+        start_rss = current_rss()
+        start = time.perf_counter()
+        gen_spectro.gen_file(spectro_arguments, wav_file, output)
+        duration = time.perf_counter() - start
+        output_bytes = sum(os.path.getsize(os.path.join(tmp_dir, filename)) for filename in os.listdir(tmp_dir))
+    return {'time': duration, 'start_rss': start_rss, 'peak_rss': peak_rss(), 'output_bytes': output_bytes}
+
+def bench_butter(args, wav_args):
+    """Times the Butterworth highpass filter on a synthetic wav file, audio decoding excluded"""
+    wav_file = synthetic_wav(*wav_args)
+    data, sample_rate = soundfile.read(wav_file)
+    start_rss = current_rss()
+    start = time.perf_counter()
+    gen_spectro.butter_highpass_filter(data, args.butter_cutoff, sample_rate, args.butter_order)
+    duration = time.perf_counter() - start
+    return {'time': duration, 'start_rss': start_rss, 'peak_rss': peak_rss()}
+
+def bench_seed(args, nb_files, nb_users):
+    """Times gen_seed.main on a synthetic seed folder"""
+    import gen_seed
+    seed_folder = synthetic_seed(args.data_folder, nb_files, nb_users)
+    start_rss = current_rss()
+    start = time.perf_counter()
+    gen_seed.main(seed_folder)
+    duration = time.perf_counter() - start
+    return {'time': duration, 'start_rss': start_rss, 'peak_rss': peak_rss(), 'output_bytes': (seed_folder / 'init.js').stat().st_size}
+
+def run_case(function_name, args, case_args):
+    """Worker function running a benchmark in a fresh process so its peak memory is its own"""
+    return globals()[function_name](args, *case_args)
+
+def run(args):
+    """Runs the benchmarks and saves their results to args.output"""
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'memory': os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        },
+        'args': {key: value for key, value in vars(args).items() if key not in ['command', 'output', 'data_folder', 'only']},
+        'results': {}
+    }
+    spawn = multiprocessing.get_context('spawn')
+    for name, function_name, case_args, memory in make_cases(args):
+        if memory > gen_spectro.available_memory():
+            print(f"{name:32} skipped, needs {memory / 2**20:.0f}MB", flush=True)
+            results['results'][name] = {'skipped': f"needs {memory / 2**20:.0f}MB"}
+            continue
+        # Input data is generated beforehand so it is not timed
+        if function_name == 'bench_seed':
+            synthetic_seed(args.data_folder, *case_args)
+        else:
+            synthetic_wav(*case_args[0])
+        runs = []
+        for _ in range(args.repeat):
+            with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+                runs.append(pool.submit(run_case, function_name, args, case_args).result())
+        result = dict(min(runs, key=lambda run_result: run_result['time']), peak_rss=max(run_result['peak_rss'] for run_result in runs))
+        results['results'][name] = result
+        print(f"{name:32} {result['time']:10.3f}s {result['peak_rss'] / 2**20:10.1f}MB", flush=True)
+
+    with open(args.output, 'w') as results_f:
+        json.dump(results, results_f, indent=2)
+
+def compare(args):
+    """Prints the time and memory changes of args.results against args.baseline, returns the regressed benchmark names"""
+    with open(args.baseline, 'r') as baseline_f:
+        baseline = json.load(baseline_f)
+    with open(args.results, 'r') as results_f:
+        results = json.load(results_f)
+    if baseline['machine'] != results['machine']:
+        print('WARNING: results were not made on the same machine as the baseline')
+    if baseline['args'] != results['args']:
+        print('WARNING: results were not made with the same benchmark arguments as the baseline')
+
+    regressions = []
+    limit = 1 + args.threshold / 100
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or 'skipped' in base or 'skipped' in result:
+            print(f"{name:32} {'no baseline' if base is None else 'skipped'}")
+            continue
+        flags = []
+        if result['time'] > base['time'] * limit and result['time'] - base['time'] > args.min_time:
+            flags.append('TIME')
+        if result['peak_rss'] > base['peak_rss'] * limit and result['peak_rss'] - base['peak_rss'] > args.min_memory * 2**20:
+            flags.append('MEMORY')
+        if flags:
+            regressions.append(name)
+        print(f"{name:32} {base['time']:9.3f}s -> {result['time']:9.3f}s ({result['time'] / base['time'] - 1:+7.1%})"
+              f" {base['peak_rss'] / 2**20:9.1f}MB -> {result['peak_rss'] / 2**20:9.1f}MB ({result['peak_rss'] / base['peak_rss'] - 1:+7.1%})"
+              f"{' REGRESSION ' + ','.join(flags) if flags else ''}")
+    print(f"{len(regressions)} regressions over {len(results['results'])} benchmarks")
+    return regressions
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif compare(args):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
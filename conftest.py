@@ -0,0 +1,19 @@
+"""
+Shared pytest fixtures of the script tests
+"""
+
+import numpy as np
+import pytest
+import soundfile
+
+
+@pytest.fixture
+def write_wav():
+    """Returns a function writing duration seconds of a noisy tone at sample_rate to path, and returning path"""
+    def write(path, duration, sample_rate=8000, frequency=1000, seed=0):
+        rng = np.random.default_rng(seed)
+        times = np.arange(int(duration * sample_rate)) / sample_rate
+        samples = 0.1 * rng.standard_normal(len(times)) + 0.5 * np.sin(2 * np.pi * frequency * times)
+        soundfile.write(str(path), samples, sample_rate)
+        return str(path)
+    return write
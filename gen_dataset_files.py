@@ -0,0 +1,122 @@
+#!/bin/python3
+"""
+Generates dataset_files.csv of a folder of wav files from their headers, replacing gen_dataset_files.rb
+"""
+
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+import soundfile
+
+
+PARSER = argparse.ArgumentParser(description='Script that generates dataset_files.csv from the headers of the wav files of a folder')
+PARSER.add_argument('folder', nargs='?', default='.', help='Folder of the wav files (default current folder)')
+PARSER.add_argument('--dataset-name', type=str, default='Glider SPAms 2019', help='Dataset name of the files')
+PARSER.add_argument('--date-regex', type=str, default=r'^[^_]*_[^_]*_([^_]*)_([^_.]*)', help='Regex whose groups, joined, are the start date of a filename (default the third and fourth _ separated parts)')
+PARSER.add_argument('--date-format', type=str, default='%d%m%y%H%M%S', help='strptime format of the joined --date-regex groups')
+PARSER.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of threads reading wav headers')
+PARSER.add_argument('--cache', type=str, default=None, help='JSON file caching header metadata by path, mtime and size (default .audio_metadata.json in folder)')
+PARSER.add_argument('--with-size', action='store_true', help='Adds a size column that gen_seed.py then uses instead of stat-ing every file')
+PARSER.add_argument('--seed', action='store_true', help='Also generates the gen_seed.py init.js of folder from the read metadata')
+
+HEADER = ['dataset_name', 'filename', 'audio_start', 'audio_end', 'audio_sample_rate_khz']
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def header_metadata(path):
+    """Returns the metadata of the wav file at path read from its header"""
+    stat = os.stat(path)
+    info = soundfile.info(path)
+    return {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'frames': info.frames,
+        'sample_rate': info.samplerate,
+        'channels': info.channels,
+        'subtype': info.subtype,
+        'duration': info.frames / info.samplerate
+    }
+
+def read_metadata(folder, filenames, jobs=None, cache_file=None):
+    """Returns the header metadata of filenames in folder by filename, reading headers in parallel
+
+    Metadata of files whose mtime and size did not change is taken from cache_file, which is then updated.
+    """
+    cache = {}
+    if cache_file is not None:
+        try:
+            with open(cache_file, 'r') as cache_f:
+                cache = json.load(cache_f)
+        except (OSError, ValueError):
+            pass
+
+    metadata = {}
+    missing = []
+    for filename in filenames:
+        path = os.path.abspath(os.path.join(folder, filename))
+        stat = os.stat(path)
+        cached = cache.get(path)
+        if cached is not None and cached['mtime_ns'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            metadata[filename] = cached
+        else:
+            missing.append(filename)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs or os.cpu_count())) as executor:
+        paths = [os.path.abspath(os.path.join(folder, filename)) for filename in missing]
+        for filename, file_metadata in zip(missing, executor.map(header_metadata, paths)):
+            metadata[filename] = file_metadata
+
+    if cache_file is not None and missing:
+        cache.update({os.path.abspath(os.path.join(folder, filename)): file_metadata for filename, file_metadata in metadata.items()})
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as cache_f:
+            json.dump(cache, cache_f)
+        os.replace(temp_file, cache_file)
+    return metadata
+
+def file_start(filename, date_regex, date_format):
+    """Returns the start datetime of filename from the groups of date_regex parsed with date_format"""
+    match = re.search(date_regex, filename)
+    if match is None:
+        raise ValueError(f"Filename {filename} does not match date regex {date_regex}")
+    return datetime.strptime(''.join(match.groups()), date_format)
+
+def dataset_files_rows(metadata, dataset_name, date_regex, date_format, with_size=False):
+    """Returns the dataset_files.csv rows of files metadata, durations being truncated to the second like soxi -D"""
+    rows = []
+    for filename, file_metadata in sorted(metadata.items()):
+        start = file_start(filename, date_regex, date_format)
+        end = start + timedelta(seconds=file_metadata['frames'] // file_metadata['sample_rate'])
+        row = [dataset_name, filename, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT), str(file_metadata['sample_rate'] / 1000.0)]
+        if with_size:
+            row.append(str(file_metadata['size']))
+        rows.append(row)
+    return rows
+
+def write_dataset_files(csv_file, rows, with_size=False):
+    """Writes rows to csv_file in the gen_dataset_files.rb layout"""
+    header = HEADER + (['size'] if with_size else [])
+    with open(csv_file, 'w') as csv_f:
+        csv_f.write('\n'.join(', '.join(row) for row in [header] + rows))
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    cache_file = args.cache or os.path.join(args.folder, '.audio_metadata.json')
+
+    filenames = sorted(filename for filename in os.listdir(args.folder) if filename.endswith('.wav'))
+    metadata = read_metadata(args.folder, filenames, args.jobs, cache_file)
+    rows = dataset_files_rows(metadata, args.dataset_name, args.date_regex, args.date_format, args.with_size)
+    write_dataset_files(os.path.join(args.folder, 'dataset_files.csv'), rows, args.with_size)
+    print(f"Wrote dataset_files.csv with {len(rows)} files")
+
+    if args.seed:
+        import gen_seed
+        gen_seed.main(Path(args.folder), files_metadata=metadata)
+
+if __name__ == '__main__':
+    main()
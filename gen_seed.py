@@ -2,6 +2,14 @@
 
 import argparse
 import csv
+import hashlib
+import json
+import os
+import secrets
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 from pathlib import Path
 from string import Template
 import bcrypt
@@ -10,6 +18,12 @@ import initjs_templates
 
 PARSER = argparse.ArgumentParser(description='Script that generates a png spectrogram from an audio wav file')
 PARSER.add_argument('seed_folder', help='Path to the folder containing wav files and the three required CSVs')
+PARSER.add_argument('--bulk', action='store_true', help='Writes one CSV file per table in the seed_csv subfolder and an init.js loading them with PostgreSQL COPY')
+PARSER.add_argument('--copy-folder', type=str, default=None, help='Path of the seed_csv folder as seen by the PostgreSQL server (default its absolute path)')
+PARSER.add_argument('--bcrypt-rounds', type=int, default=12, help='bcrypt cost factor of users.csv password hashes (default 12)')
+PARSER.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of processes hashing users.csv passwords')
+PARSER.add_argument('--password-cache', type=str, default=None, help='JSON file keeping the password hashes of users.csv so unchanged users keep their hash across reseeds')
+PARSER.add_argument('--sqlite', type=str, default=None, help='With --bulk, loads the CSV files in this SQLite database to check them and time the load')
 USERS = [
     'admin@test.ode',
     'dc@test.ode',
@@ -38,12 +52,113 @@ SEED_TABLES = [
 START_INDEX = 100
 END_INDEX = 1000
 MAX_INSERT = 10000
+# Bulk mode CSV files subfolder and NULL marker (missing audio_metadata fields)
+BULK_FOLDER = 'seed_csv'
+# Sidecar of the seed folder giving dataset_files ids by filename, read by unzip_spectros.py
+FILE_IDS = 'dataset_file_ids.json'
+NULL_CSV = '\\N'
+# Table referenced by each foreign key column, checked by the SQLite loader
+FOREIGN_KEYS = {
+    'owner_id': 'users',
+    'annotator_id': 'users',
+    'dataset_type_id': 'dataset_types',
+    'geo_metadata_id': 'geo_metadata',
+    'audio_metadata_id': 'audio_metadata',
+    'dataset_id': 'datasets',
+    'dataset_file_id': 'dataset_files',
+    'annotation_set_id': 'annotation_sets',
+    'annotation_tag_id': 'annotation_tags',
+    'annotation_campaign_id': 'annotation_campaigns'
+}
 
 # TODO add header checking for CSV
 
-def main(seed_folder):
-    inserts = ""
+def hash_password(password, rounds):
+    """Returns the bcrypt hash of password with cost factor rounds"""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
 
+class PasswordHasher:
+    """Hashes user passwords with bcrypt over jobs processes, reusing the hashes kept in cache_file for unchanged users
+
+    Cached hashes are looked up by email and a keyed fingerprint of the password and cost factor, the key
+    being random and stored in cache_file. Users missing from the last hashed list are dropped from it.
+    """
+
+    def __init__(self, rounds=12, jobs=None, cache_file=None):
+        self.rounds = rounds
+        self.jobs = jobs or os.cpu_count()
+        self.cache_file = cache_file
+
+    def load_cache(self):
+        """Returns the cache_file content, or a new empty cache"""
+        if self.cache_file is not None:
+            try:
+                with open(self.cache_file, 'r') as cache_f:
+                    return json.load(cache_f)
+            except (OSError, ValueError):
+                pass
+        return {'key': secrets.token_hex(32), 'users': {}}
+
+    def save_cache(self, cache):
+        """Atomically writes cache to cache_file, readable by its owner only"""
+        temp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_f:
+            json.dump(cache, cache_f)
+        os.replace(temp_file, self.cache_file)
+
+    def hash_users(self, users_input):
+        """Returns the password hashes of users_input (dicts with user and password keys)"""
+        cache = self.load_cache()
+        fingerprints = [
+            hashlib.blake2b(f"{self.rounds}:{user['password']}".encode(), key=bytes.fromhex(cache['key']), person=b'gen_seed').hexdigest()
+            for user in users_input
+        ]
+        hashes = [None] * len(users_input)
+        for i, user in enumerate(users_input):
+            cached = cache['users'].get(user['user'])
+            if cached is not None and cached['fingerprint'] == fingerprints[i]:
+                hashes[i] = cached['hash']
+
+        missing = [i for i, password_hash in enumerate(hashes) if password_hash is None]
+        passwords = [users_input[i]['password'] for i in missing]
+        if len(missing) > 1 and self.jobs > 1:
+            with ProcessPoolExecutor(max_workers=min(self.jobs, len(missing))) as executor:
+                new_hashes = list(executor.map(hash_password, passwords, [self.rounds] * len(passwords), chunksize=max(1, len(missing) // (4 * self.jobs))))
+        else:
+            new_hashes = [hash_password(password, self.rounds) for password in passwords]
+        for i, password_hash in zip(missing, new_hashes):
+            hashes[i] = password_hash
+
+        if self.cache_file is not None:
+            cache['users'] = {
+                user['user']: {'fingerprint': fingerprint, 'hash': password_hash}
+                for user, fingerprint, password_hash in zip(users_input, fingerprints, hashes)
+            }
+            self.save_cache(cache)
+        return hashes
+
+def file_size(seed_folder, dataset_file, files_metadata=None):
+    """Returns the size of a dataset_files.csv file from files_metadata, its size column or the file itself"""
+    if files_metadata is not None and dataset_file['filename'] in files_metadata:
+        return files_metadata[dataset_file['filename']]['size']
+    if dataset_file.get('size'):
+        return int(dataset_file['size'])
+    return (seed_folder / dataset_file['filename']).stat().st_size
+
+def write_file_ids(ids_file, dataset_files):
+    """Writes the ids of dataset_files rows by filename to the JSON ids_file"""
+    temp_file = ids_file.with_name(ids_file.name + '.tmp')
+    with open(temp_file, 'w') as ids_f:
+        json.dump({dataset_file['filename']: dataset_file['id'] for dataset_file in dataset_files}, ids_f, indent=1)
+    temp_file.replace(ids_file)
+
+def seed_tables(seed_folder, hasher=None, files_metadata=None):
+    """Yields (table, rows) of the seed of seed_folder in insertion order, or (None, sql) for raw SQL statements
+
+    Rows are lists of dicts, except annotation_tasks rows that are generated lazily.
+    users.csv passwords are hashed by hasher, a default PasswordHasher when None.
+    File sizes are taken from files_metadata (see gen_dataset_files.py) when given.
+    """
     # Loading CSV files data in a dict
     data = {}
     for file in REQUIRED_FILES:
@@ -56,11 +171,12 @@ def main(seed_folder):
     if users_csv.exists():
         with open(users_csv, 'r') as csvfile:
             users_input = list(csv.DictReader(csvfile, skipinitialspace=True))
+        password_hashes = (hasher or PasswordHasher()).hash_users(users_input)
         for i, user in enumerate(users_input):
             users.append({
                 'id': START_INDEX + i + 1,
                 'email': user['user'],
-                'password': bcrypt.hashpw(user['password'].encode(), bcrypt.gensalt()).decode()
+                'password': password_hashes[i]
             })
     else:
         for i, user in enumerate(USERS):
@@ -69,10 +185,7 @@ def main(seed_folder):
                 'email': user,
                 'password': USER_MDP
             })
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'users',
-        'inserts': users
-    })
+    yield 'users', users
 
     # Generating dataset_types
     dataset_types = {
@@ -83,10 +196,7 @@ def main(seed_folder):
     }
     for i, key in enumerate(dataset_types.keys()):
         dataset_types[key]['id'] = START_INDEX + i + 1
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'dataset_types',
-        'inserts': list(dataset_types.values())
-    })
+    yield 'dataset_types', list(dataset_types.values())
 
     # Generating geo_metadata
     geo_metadata = {
@@ -103,15 +213,10 @@ def main(seed_folder):
         latlon = geo_metadata[key].pop('location')
         if latlon.strip(' ,') != '':
             location = f"POINT({latlon})"
-            sql_locations.append(Template(initjs_templates.raw_sql).substitute({
-                'sql': f"UPDATE geo_metadata SET location = {location} WHERE id = {i + 1}"
-            }))
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'geo_metadata',
-        'inserts': list(geo_metadata.values())
-    })
+            sql_locations.append(f"UPDATE geo_metadata SET location = {location} WHERE id = {i + 1}")
+    yield 'geo_metadata', list(geo_metadata.values())
     for sql_location in sql_locations:
-        inserts += sql_location
+        yield None, sql_location
 
     # Generating audio_metadata
     dataset_audio_metadata = {
@@ -127,10 +232,7 @@ def main(seed_folder):
     audio_metadata = { **dataset_audio_metadata, **dataset_files_audio_metadata }
     for i, key in enumerate(audio_metadata.keys()):
         audio_metadata[key]['id'] = START_INDEX + i + 1
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'audio_metadata',
-        'inserts': list(audio_metadata.values())
-    })
+    yield 'audio_metadata', list(audio_metadata.values())
 
     # Generating datasets
     datasets = {
@@ -148,26 +250,21 @@ def main(seed_folder):
     }
     for i, key in enumerate(datasets.keys()):
         datasets[key]['id'] = START_INDEX + i + 1
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'datasets',
-        'inserts': list(datasets.values())
-    })
+    yield 'datasets', list(datasets.values())
 
     # Generating dataset_files
     dataset_files = {
         dsf['filename']:{
             'filename': dsf['filename'],
-            'size': (seed_folder / dsf['filename']).stat().st_size,
+            'size': file_size(seed_folder, dsf, files_metadata),
             'dataset_id': datasets[dsf['dataset_name']]['id'],
             'audio_metadata_id': audio_metadata[dsf['filename']]['id']
         } for dsf in data['dataset_files.csv']
     }
     for i, key in enumerate(dataset_files.keys()):
         dataset_files[key]['id'] = START_INDEX + i + 1
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'dataset_files',
-        'inserts': list(dataset_files.values())
-    })
+    write_file_ids(seed_folder / FILE_IDS, dataset_files.values())
+    yield 'dataset_files', list(dataset_files.values())
 
     # Generating annotation_sets
     annotation_sets = {
@@ -179,10 +276,7 @@ def main(seed_folder):
     }
     for i, key in enumerate(annotation_sets.keys()):
         annotation_sets[key]['id'] = START_INDEX + i + 1
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'annotation_sets',
-        'inserts': list(annotation_sets.values())
-    })
+    yield 'annotation_sets', list(annotation_sets.values())
 
     # Generating annotation_tags
     annotation_tags = {
@@ -191,10 +285,7 @@ def main(seed_folder):
             'name': tag.strip()
         } for i, tag in enumerate(','.join(annotation_sets.keys()).split(','))
     }
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'annotation_tags',
-        'inserts': list(annotation_tags.values())
-    })
+    yield 'annotation_tags', list(annotation_tags.values())
 
     # Generating annotation_set_tags_id
     annotation_set_tags = []
@@ -207,10 +298,7 @@ def main(seed_folder):
                 'annotation_set_id': annotation_sets[annotation_set]['id'],
                 'annotation_tag_id': annotation_tags[tag]['id']
             })
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'annotation_set_tags',
-        'inserts': annotation_set_tags
-    })
+    yield 'annotation_set_tags', annotation_set_tags
 
     # Generating annotation_campaigns
     annotation_campaigns = {
@@ -226,10 +314,7 @@ def main(seed_folder):
     }
     for i, key in enumerate(annotation_campaigns.keys()):
         annotation_campaigns[key]['id'] = START_INDEX + i + 1
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'annotation_campaigns',
-        'inserts': list(annotation_campaigns.values())
-    })
+    yield 'annotation_campaigns', list(annotation_campaigns.values())
 
     # Generating annotation_campaign_datasets
     annotation_campaign_datasets = []
@@ -239,37 +324,126 @@ def main(seed_folder):
             'annotation_campaign_id': annotation_campaigns[line['name']]['id'],
             'dataset_id': datasets[line['dataset_name']]['id']
         })
-    inserts += Template(initjs_templates.del_insert).substitute({
-        'table': 'annotation_campaign_datasets',
-        'inserts': annotation_campaign_datasets
-    })
+    yield 'annotation_campaign_datasets', annotation_campaign_datasets
 
 
-    # Generating annotation_tasks
-    user_count = initjs_templates.initjs.count('@test.ode')
-    annotation_tasks = []
+    # Generating annotation_tasks lazily
     annotation_files = { dataset['id']:[] for dataset in datasets.values() }
     for dataset_file in dataset_files.values():
         annotation_files[dataset_file['dataset_id']].append(dataset_file['id'])
+    yield 'annotation_tasks', gen_annotation_tasks(annotation_campaign_datasets, annotation_files, users)
+
+def gen_annotation_tasks(annotation_campaign_datasets, annotation_files, users):
+    """Yields the annotation task of every campaign file for every user"""
     k_id = 0
     for campaign in annotation_campaign_datasets:
         for file_id in annotation_files[campaign['dataset_id']]:
             for user in users:
                 k_id += 1
-                annotation_tasks.append({
+                yield {
                     'id': START_INDEX + k_id,
                     'annotation_campaign_id': campaign['annotation_campaign_id'],
                     'dataset_file_id': file_id,
                     'status': 0,
                     'annotator_id': user['id']
+                }
+
+def knex_promises(seed_folder, hasher=None, files_metadata=None):
+    """Yields the knex promise chain inserting the seed of seed_folder piece by piece"""
+    for table, rows in seed_tables(seed_folder, hasher, files_metadata):
+        if table is None:
+            yield Template(initjs_templates.raw_sql).substitute({'sql': rows})
+        elif isinstance(rows, list):
+            yield Template(initjs_templates.del_insert).substitute({
+                'table': table,
+                'inserts': rows
+            })
+        else:
+            # Lazily generated rows are inserted MAX_INSERT at a time
+            yield Template(initjs_templates.deletion).substitute({'table': table})
+            while True:
+                rows_batch = list(islice(rows, MAX_INSERT))
+                if not rows_batch:
+                    break
+                yield Template(initjs_templates.insertion).substitute({
+                    'table': table,
+                    'inserts': rows_batch
                 })
-    inserts += Template(initjs_templates.deletion).substitute({'table': 'annotation_tasks'})
-    for i in range(0, len(annotation_tasks), MAX_INSERT):
-        inserts += Template(initjs_templates.insertion).substitute({
-            'table': 'annotation_tasks',
-            'inserts': annotation_tasks[i:i + MAX_INSERT]
+
+def copy_promises(seed_folder, copy_folder=None, hasher=None, files_metadata=None):
+    """Writes every table of the seed of seed_folder to a CSV file of its BULK_FOLDER and yields the knex promise chain loading them with COPY
+
+    copy_folder is the path of the CSV files as seen by the PostgreSQL server, which must be able to read them.
+    """
+    csv_folder = seed_folder / BULK_FOLDER
+    csv_folder.mkdir(exist_ok=True)
+    copy_folder = copy_folder or str(csv_folder.resolve())
+    for table, rows in seed_tables(seed_folder, hasher, files_metadata):
+        if table is None:
+            yield Template(initjs_templates.raw_sql).substitute({'sql': rows})
+            continue
+        columns = write_table_csv(csv_folder / f"{table}.csv", rows)
+        if not columns:
+            yield Template(initjs_templates.deletion).substitute({'table': table})
+            continue
+        yield Template(initjs_templates.del_copy).substitute({
+            'table': table,
+            # Columns like desc or end are SQL keywords and are double quoted, escaped in the JS string
+            'columns': ', '.join(f'\\"{column}\\"' for column in columns),
+            'path': f"{copy_folder}/{table}.csv"
         })
 
+def write_table_csv(csv_file, rows):
+    """Writes rows to csv_file with a header of all their keys, missing values being NULL_CSV, returns the columns"""
+    if isinstance(rows, list):
+        columns = list({key: None for row in rows for key in row})
+    else:
+        # Lazily generated rows all have the keys of the first one
+        first_row = next(rows, None)
+        if first_row is None:
+            columns, rows = [], []
+        else:
+            columns, rows = list(first_row), chain([first_row], rows)
+    with open(csv_file, 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(columns)
+        writer.writerows([row.get(column, NULL_CSV) for column in columns] for row in rows)
+    return columns
+
+def load_sqlite(csv_folder, db_file):
+    """Loads the bulk CSV files of csv_folder in the SQLite database db_file, returns the rows count of every table
+
+    Stands in for the PostgreSQL COPY seed: ids must be unique and foreign keys must reference loaded rows.
+    """
+    connection = sqlite3.connect(db_file)
+    connection.execute('PRAGMA foreign_keys=ON')
+    counts = {}
+    with connection:
+        for table in reversed(SEED_TABLES):
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+        for table in SEED_TABLES:
+            with open(csv_folder / f"{table}.csv", 'r', newline='') as csv_f:
+                reader = csv.reader(csv_f)
+                columns = next(reader)
+                if not columns:
+                    continue
+                definitions = [
+                    'id INTEGER PRIMARY KEY' if column == 'id'
+                    else f'"{column}" REFERENCES {FOREIGN_KEYS[column]}(id)' if column in FOREIGN_KEYS
+                    else f'"{column}"'
+                    for column in columns
+                ]
+                connection.execute(f"CREATE TABLE {table} ({', '.join(definitions)})")
+                connection.executemany(
+                    f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})",
+                    ([None if value == NULL_CSV else value for value in row] for row in reader)
+                )
+            counts[table] = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    connection.close()
+    return counts
+
+def main(seed_folder, bulk=False, copy_folder=None, hasher=None, files_metadata=None):
+    """Streams the knex seed init.js of seed_folder to disk, loading BULK_FOLDER CSV files written along with bulk"""
     # No init at the moment
     init = ''
 
@@ -279,12 +453,26 @@ def main(seed_folder):
         }) for table in SEED_TABLES
     ])
 
-    template_data = { 'init': init, 'promises': inserts, 'finish': finish }
-    with open(seed_folder / 'init.js', 'w') as res_f:
-        res_f.write(Template(initjs_templates.initjs).substitute(template_data))
+    # The promise chain is written between both halves of the initjs template as it is generated
+    head, tail = initjs_templates.initjs.split('$promises')
+    temp_file = seed_folder / 'init.js.tmp'
+    with open(temp_file, 'w') as res_f:
+        res_f.write(Template(head).substitute({ 'init': init }))
+        promises = copy_promises(seed_folder, copy_folder, hasher, files_metadata) if bulk else knex_promises(seed_folder, hasher, files_metadata)
+        for promise in promises:
+            res_f.write(promise)
+        res_f.write(Template(tail).substitute({ 'finish': finish }))
+    temp_file.replace(seed_folder / 'init.js')
 
 if __name__ == '__main__':
 
     ARGS = PARSER.parse_args()
 
-    main(Path(ARGS.seed_folder))
+    HASHER = PasswordHasher(ARGS.bcrypt_rounds, ARGS.jobs, ARGS.password_cache)
+    main(Path(ARGS.seed_folder), ARGS.bulk, ARGS.copy_folder, HASHER)
+
+    if ARGS.bulk and ARGS.sqlite:
+        START = time.perf_counter()
+        COUNTS = load_sqlite(Path(ARGS.seed_folder) / BULK_FOLDER, ARGS.sqlite)
+        print(f"Loaded {sum(COUNTS.values())} rows of {len(COUNTS)} tables in {time.perf_counter() - START:.2f}s: "
+              + ', '.join(f"{table}={count}" for table, count in COUNTS.items()))
@@ -1,14 +1,61 @@
 #!/bin/python3
 
 import argparse
+import contextlib
+import copy
+import functools
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import struct
+import tempfile
+import time
+import zlib
 import soundfile
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
+import scipy.fft
 from scipy import signal
 
+from manifest import RunManifest
+from psd_cache import PSDCache
+from tile_archive import COMPRESSIONS, TileArchive
+
+
+RENDERERS = ['raster', 'matplotlib', 'check']
+# Matplotlib figure geometry (in pixels), png outputs are cropped to the axes area of the figure
+MY_DPI = 100
+FIG_WIDTH = 1.3 * 1800
+FIG_HEIGHT = 1.3 * 512
+AXES_WIDTH = 0.775 * FIG_WIDTH
+AXES_HEIGHT = 0.77 * FIG_HEIGHT
+# Parameter set keys (see --params) and the args attribute and type they override
+PARAM_SET_KEYS = {
+    'nfft': ('nfft', int),
+    'winsize': ('win_size', int),
+    'overlap': ('overlap', float),
+    'cvr': ('color_val_range', str),
+    'mw': ('max_bgw', float),
+}
+# Frames windowed and transformed at once by each thread of the float32 STFT kernel
+FLOAT32_CHUNK_FRAMES = 1024
+# Memory (in bytes) used by the png rendering temporaries on top of the PSD
+RENDER_MEMORY = 64 * 2**20
+# Args that change rendered tiles, recorded by --manifest (tiles do not depend on tile_levels)
+MANIFEST_ARGS = ['nfft', 'win_size', 'overlap', 'freq_plot_range', 'freq_dyn_range', 'color_val_range', 'cmap_color', 'butter_order',
+                 'filter_block', 'max_bgw', 'pyramid', 'float32', 'renderer']
 
 PARSER = argparse.ArgumentParser(description='Script that generates a png spectrogram from an audio wav file')
-PARSER.add_argument('audio_file', help='Filepath of the input audio wav file')
+PARSER.add_argument('audio_file', help='Filepath of the input audio wav file, or with --batch a folder of wav files or a text file listing them')
 PARSER.add_argument('--nfft', '-n', type=int, default=4096, help='NFFT parameter for spectrogram (in samples)')
 PARSER.add_argument('--win_size', '-w', type=int, default=4096, help='Window size parameter for spectrogram (in samples)')
 PARSER.add_argument('--overlap', '-o', type=float, default=0, help='Overlap parameter for spectrogram (in percent)')
@@ -18,8 +65,27 @@ PARSER.add_argument('--color_val_range', '-cvr', type=str, default=None, help='S
 PARSER.add_argument('--cmap_color', '-c', type=str, default='Greys', help='CMAP color parameter for spectrogram (cf matplotlib)')
 PARSER.add_argument('--tile-levels', '-tl', type=int, default=1, help='Number of wanted tile levels (default 1)')
 PARSER.add_argument('--butter-order', '-b', type=int, default=None, help='Order level for Butterworth highpass digital filter')
+PARSER.add_argument('--filter-block', type=float, default=None, help='Applies the Butterworth filter in blocks of this duration (in s) to bound its memory, blocks overlap by the filter impulse response length')
+PARSER.add_argument('--cache-filtered', action='store_true', help='Also caches the filtered audio in the --psd-cache folder so other parameters skip filtering')
 PARSER.add_argument('--max-bgw', '-mw', type=float, default=None, help='Fix value for spectro background highlighting')
-PARSER.add_argument('output', nargs='?', help='Desired ouput filepath')
+PARSER.add_argument('--pyramid', '-p', action='store_true', help='Compute the STFT once and slice every zoom tile out of it')
+PARSER.add_argument('--float32', action='store_true', help='Computes the PSD in float32 with a low allocation multi-threaded kernel (PSD error below 1e-6 of the frame peak PSD, 0.001 dB within 60 dB of it)')
+PARSER.add_argument('--fft-threads', type=int, default=os.cpu_count(), help='Number of FFT threads of the float32 kernel')
+PARSER.add_argument('--tile-jobs', type=int, default=1, help='Renders the tiles of each level after level 0 concurrently, their PSDs being computed by this many threads and rendered by as many worker processes (not with --max-memory)')
+PARSER.add_argument('--max-memory', '-mm', type=float, default=None, help='Streams the audio file in blocks to keep memory around this budget (in MB), tiles are then made in pyramid mode')
+PARSER.add_argument('--renderer', '-r', choices=RENDERERS, default='raster', help='Spectrogram png renderer, check renders with raster and prints its pixel diff against matplotlib')
+PARSER.add_argument('--psd-cache', type=str, default=None, help='Folder where computed PSDs are cached, re-renders with other colors or ranges then skip decoding, filtering and FFT')
+PARSER.add_argument('--psd-cache-size', type=float, default=10240, help='PSD cache size limit (in MB), least recently used entries are evicted')
+PARSER.add_argument('--params', '-ps', action='append', default=None, help='Parameter set overriding nfft, winsize, overlap, cvr or mw like "nfft=2048 winsize=512 overlap=90 cvr=-90:0", can be repeated to make each set from a single audio decoding in a subfolder named after it')
+PARSER.add_argument('--stats', type=str, default=None, help='JSON stats file of spectro_stats.py whose dataset-wide max_bgw and color_val_range are used by parameter sets that do not set them')
+PARSER.add_argument('--profile', type=str, default=None, help='Appends JSON-lines records of stage timings, array sizes, peak RSS and output bytes of every file, level and tile to this file')
+PARSER.add_argument('--manifest', type=str, default=None, help='SQLite file recording the content hash, settings and completed tiles of every output, finished outputs are then skipped and interrupted ones resumed tile by tile')
+PARSER.add_argument('--archive', choices=list(COMPRESSIONS), default=None, help='Streams the png tiles into a gz (.tgz) or zst (.tar.zst) archive of the output folder instead of writing them, with an index member to extract single tiles (see tile_archive.py)')
+PARSER.add_argument('--archive-level', type=int, default=None, help='Compression level of --archive (default 6 for gz, 3 for zst)')
+PARSER.add_argument('--batch', action='store_true', help='Processes all given wav files with a pool of worker processes')
+PARSER.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Maximum number of worker processes in batch mode')
+PARSER.add_argument('--batch-memory', type=float, default=None, help='Memory (in MB) shared by concurrent jobs in batch mode (default available memory)')
+PARSER.add_argument('output', nargs='?', help='Desired ouput filepath, or with --batch the output folder relative to each wav file, {name} being replaced by its basename (default {name})')
 
 
 class Range:
@@ -54,7 +120,7 @@ class Range:
         return f"Range({self.min}:{self.max})"
 
 class SpectroGenerator:
-    def __init__(self, nfft, win_size, pct_overlap, cmap_color, freq_plot_range=None, freq_dyn_range=None, color_val_range=None):
+    def __init__(self, nfft, win_size, pct_overlap, cmap_color, freq_plot_range=None, freq_dyn_range=None, color_val_range=None, renderer='raster', max_memory=None, float32=False, fft_threads=1):
         self.nfft = nfft
         self.win_size = win_size
         self.pct_overlap = pct_overlap
@@ -66,13 +132,137 @@ class SpectroGenerator:
         self.min_color_val = color_val_range.min if color_val_range else None
         self.max_color_val = color_val_range.max if color_val_range else None
         self.max_w = 1
+        if renderer not in RENDERERS:
+            raise ValueError(f"Renderer should be one of {RENDERERS} and not {renderer}")
+        self.renderer = renderer
+        self.max_memory = max_memory
+        self.float32 = float32
+        self.fft_threads = fft_threads
+        # Highpass Butterworth (order, cutoff) applied block-wise on streamed audio, optionally cached in psd_cache
+        self.butter = None
+        self.cache_filtered = False
+        # PSDs are cached when psd_cache is set, psd_source then identifies the (filtered) audio
+        self.psd_cache = None
+        self.psd_source = None
+        # Stage timings are recorded when profiler is set to a StageProfiler
+        self.profiler = None
+        # Tiles completed by a previous run are skipped when manifest_job is set to a ManifestJob
+        self.manifest_job = None
+        # Png tiles are added to archive as their path relative to archive_root when set to a TileArchive
+        self.archive = None
+        self.archive_root = None
+        # Tiles of a level are rendered by a TileRenderPool of tile_jobs workers when above 1
+        self.tile_jobs = 1
 
     def gen_spectro(self, data, sample_rate, output_file, main_ref=False, shorten=False, window_type='hamming'):
+        """Computes the spectrogram of data and saves it as a png to output_file"""
+        with self.tile_record(0, 1, 0, output_file, len(data)):
+            segment_times, frequencies, spectro = self.get_psd(data, sample_rate, window_type=window_type)
+            self.render_spectro(segment_times, frequencies, spectro, output_file, main_ref=main_ref, shorten=shorten)
+        self.tile_completed(output_file)
+
+    def frame_step(self):
+        """Returns (nperseg, noverlap, nstep) STFT frame parameters in samples"""
         noverlap = int(self.win_size * self.pct_overlap/100)
         nperseg = self.win_size
-        nstep = nperseg - noverlap
+        return nperseg, noverlap, nperseg - noverlap
+
+    def memory_estimate(self, nb_samples):
+        """Returns the estimated peak memory (in bytes) to generate the spectros of nb_samples in memory or streamed"""
+        if self.max_memory:
+            return self.max_memory + RENDER_MEMORY
+        _, noverlap, nstep = self.frame_step()
+        nb_frames = max(0, (nb_samples - noverlap) // nstep)
+        # Parallel tiles of a level hold about a shared copy of the whole PSD, and each worker its own render temporaries
+        parallel_memory = 0
+        if self.tile_jobs > 1:
+            parallel_memory = (4 if self.float32 else 8) * nb_frames * (self.nfft // 2 + 1) + self.tile_jobs * RENDER_MEMORY
+        if self.float32:
+            return 4 * nb_samples + nb_frames * self.frame_memory(self.nfft // 2 + 1) + self.float32_chunk_memory() + RENDER_MEMORY + parallel_memory
+        return 8 * nb_samples + nb_frames * self.frame_memory(self.nfft // 2 + 1) + RENDER_MEMORY + parallel_memory
+
+    def frame_memory(self, nb_freqs):
+        """Returns the peak memory (in bytes) used per STFT frame by compute_psd"""
+        _, _, nstep = self.frame_step()
+        if self.float32:
+            # Read samples and the restricted PSD, chunk temporaries are counted by float32_chunk_memory
+            return 4 * (nstep + nb_freqs)
+        # Read samples, windowed frame, rfft zero-padded input, three complex rfft sized arrays and the restricted PSD
+        return 8 * (nstep + self.win_size + self.nfft + 6 * (self.nfft // 2 + 1) + nb_freqs)
+
+    def float32_chunk_memory(self):
+        """Returns the memory (in bytes) of the frame chunk temporaries of all float32 kernel threads"""
+        # Windowed frames, rfft zero-padded input and output, squared imaginary parts
+        per_frame = 4 * (self.win_size + self.nfft + 2 * (self.nfft // 2 + 1) + (self.nfft // 2 + 1))
+        return max(1, self.fft_threads) * FLOAT32_CHUNK_FRAMES * per_frame
 
-        win = signal.get_window(window_type, nperseg)
+    def column_blocks(self, spectro):
+        """Yields column slices of spectro so that float64 copies of each block fit in self.max_memory"""
+        nb_cols = spectro.shape[1]
+        block_cols = nb_cols
+        if self.max_memory:
+            block_cols = max(1, self.max_memory // (2 * 8 * max(1, spectro.shape[0])))
+        for first in range(0, nb_cols, block_cols):
+            yield slice(first, min(nb_cols, first + block_cols))
+
+    def psd_key(self, start, end, window_type='hamming'):
+        """Returns the PSD cache key of samples [start, end) of self.psd_source"""
+        return self.psd_cache.key(
+            source=self.psd_source,
+            dtype='float32' if self.float32 else 'float64',
+            nfft=self.nfft,
+            win_size=self.win_size,
+            overlap=self.pct_overlap,
+            window_type=window_type,
+            start=start,
+            end=end
+        )
+
+    def get_psd(self, data, sample_rate, start=0, end=None, window_type='hamming'):
+        """Returns compute_psd of data[start:end], loading it from or saving it to self.psd_cache when set
+
+        Data is only sliced when the PSD is not cached, so it can be a LazySamples that is then never decoded.
+        """
+        end = len(data) if end is None else min(end, len(data))
+        if self.psd_cache is None:
+            samples = data[start:end]
+            with span(self.profiler, 'psd'):
+                return self.compute_psd(samples, sample_rate, window_type)
+
+        key = self.psd_key(start, end, window_type)
+        with span(self.profiler, 'cache_load'):
+            psd = self.psd_cache.load(key)
+        if psd is None:
+            samples = data[start:end]
+            with span(self.profiler, 'psd'):
+                _, _, spectro = self.compute_psd(samples, sample_rate, window_type, restrict=False)
+            psd = spectro.transpose()
+            with span(self.profiler, 'cache_store'):
+                self.psd_cache.store(key, psd, dict(self.psd_source, nfft=self.nfft, win_size=self.win_size, overlap=self.pct_overlap, start=start, end=end))
+        return self.psd_view(psd, end - start, sample_rate)
+
+    def psd_view(self, psd, nb_samples, sample_rate):
+        """Returns (segment_times, frequencies, spectro) of a (frames, frequencies) PSD of nb_samples restricted to the plot frequency range
+
+        Spectro is a view of psd since the kept frequencies are a contiguous range.
+        """
+        frequencies = np.fft.rfftfreq(self.nfft, 1 / sample_rate)
+        rows = frequency_slice(frequencies, self.min_freq_plot, self.max_freq_plot)
+        return self.segment_times(nb_samples, sample_rate), frequencies[rows], psd.transpose()[rows]
+
+    def segment_times(self, nb_samples, sample_rate):
+        """Returns the center times (in seconds) of the STFT frames of nb_samples"""
+        nperseg, noverlap, _ = self.frame_step()
+        return np.arange(nperseg / 2, nb_samples - nperseg / 2 + 1, nperseg - noverlap) / float(sample_rate)
+
+    def compute_psd(self, data, sample_rate, window_type='hamming', restrict=True):
+        """Computes the PSD of data restricted to the plot frequency range, returns (segment_times, frequencies, spectro)"""
+        if self.float32:
+            return self.compute_psd_float32(data, sample_rate, window_type, restrict)
+
+        nperseg, noverlap, nstep = self.frame_step()
+
+        win = get_window(window_type, nperseg)
 
         x = np.asarray(data)
         shape = x.shape[:-1] + ((x.shape[-1] - noverlap) // nstep, nperseg)
@@ -93,108 +283,740 @@ class SpectroGenerator:
             vPSD_noBB[..., 1:-1] *= 2
 
         spectro = vPSD_noBB.real
-        segment_times = np.arange(nperseg / 2, x.shape[-1] - nperseg / 2 + 1, nperseg - noverlap) / float(sample_rate)
+        segment_times = self.segment_times(x.shape[-1], sample_rate)
         frequencies = np.fft.rfftfreq(self.nfft, 1 / sample_rate)
         spectro = spectro.transpose()
         del vPSD_noBB
 
+        if not restrict:
+            return segment_times, frequencies, spectro
+
         # Restricting spectro frenquencies
-        freqs_to_keep = (frequencies == frequencies)
-        if self.min_freq_plot:
-            freqs_to_keep *= self.min_freq_plot <= frequencies
-        if self.max_freq_plot:
-            freqs_to_keep *= frequencies <= self.max_freq_plot
+        freqs_to_keep = frequency_mask(frequencies, self.min_freq_plot, self.max_freq_plot)
         frequencies = frequencies[freqs_to_keep]
         spectro = spectro[freqs_to_keep, :]
 
-        # Setting self.max_w and normalising spectro as needed
+        return segment_times, frequencies, spectro
+
+    def compute_psd_float32(self, data, sample_rate, window_type='hamming', restrict=True):
+        """float32 compute_psd, windowing and transforming frames by chunks over self.fft_threads threads
+
+        Only the kept frequencies |X|² are computed, straight into a (frames, frequencies) array whose
+        transposed view is returned as spectro. PSD values differ from compute_psd by less than 1e-6 times
+        the peak PSD of their frame, i.e. less than 0.001 dB for bins within 60 dB of that peak.
+        """
+        nperseg, noverlap, nstep = self.frame_step()
+        win = get_window(window_type, nperseg)
+
+        x = np.asarray(data, dtype=np.float32)
+        nb_frames = max(0, (x.shape[-1] - noverlap) // nstep)
+        frames = np.lib.stride_tricks.as_strided(x, shape=(nb_frames, nperseg), strides=(nstep * x.strides[-1], x.strides[-1]))
+
+        frequencies = np.fft.rfftfreq(self.nfft, 1 / sample_rate)
+        rows = frequency_slice(frequencies, self.min_freq_plot, self.max_freq_plot) if restrict else slice(None)
+
+        # One sided PSD scaling, DC and Nyquist bins are not doubled
+        scale_psd = np.full(len(frequencies), 2.0 / (sample_rate * (win * win).sum()))
+        scale_psd[0] /= 2
+        if not self.nfft % 2:
+            scale_psd[-1] /= 2
+        scale_psd = scale_psd[rows].astype(np.float32)
+        win = win.astype(np.float32)
+
+        psd = np.empty((nb_frames, len(scale_psd)), dtype=np.float32)
+
+        def transform(first):
+            chunk = slice(first, min(nb_frames, first + FLOAT32_CHUNK_FRAMES))
+            spectrum = scipy.fft.rfft(frames[chunk] * win, n=self.nfft)[:, rows]
+            np.square(spectrum.real, out=psd[chunk])
+            psd[chunk] += np.square(spectrum.imag)
+            psd[chunk] *= scale_psd
+
+        with ThreadPoolExecutor(max_workers=max(1, self.fft_threads)) as executor:
+            list(executor.map(transform, range(0, nb_frames, FLOAT32_CHUNK_FRAMES)))
+
+        return self.segment_times(x.shape[-1], sample_rate), frequencies[rows], psd.transpose()
+
+    def render_spectro(self, segment_times, frequencies, spectro, output_file, main_ref=False, shorten=False):
+        """Normalises spectro, switches it to log scale and saves it as a png to output_file"""
+        png_data = self.spectro_png(segment_times, frequencies, spectro, output_file, main_ref, shorten)
+        with span(self.profiler, 'png'):
+            self.write_output(output_file, png_data)
+
+    def spectro_png(self, segment_times, frequencies, spectro, output_file, main_ref=False, shorten=False):
+        """Normalises spectro, switches it to log scale and returns it as png data, output_file naming it in messages"""
+        if self.profiler is not None:
+            self.profiler.note(frames=spectro.shape[1], frequencies=spectro.shape[0], spectro_bytes=spectro.shape[0] * spectro.shape[1] * spectro.itemsize)
+
+        # Setting self.max_w as needed, by column blocks to bound memory
         if main_ref:
-            # Restricting spectro frenquencies for dynamic range
-            freqs_to_keep = (frequencies == frequencies)
-            if self.min_freq_dyn:
-                freqs_to_keep *= self.min_freq_dyn <= frequencies
-            if self.max_freq_dyn:
-                freqs_to_keep *= frequencies <= self.max_freq_dyn
-            self.max_w = np.amax(spectro[freqs_to_keep, :])
-        spectro = spectro / self.max_w
+            with span(self.profiler, 'dynamic_range'):
+                # Restricting spectro frenquencies for dynamic range
+                freqs_to_keep = frequency_mask(frequencies, self.min_freq_dyn, self.max_freq_dyn)
+                self.max_w = max(np.amax(spectro[freqs_to_keep, block]) for block in self.column_blocks(spectro))
 
         # This is needed to match end of tile n with start of tile n+1
         if shorten:
             segment_times = segment_times[:-1]
             spectro = spectro[:,:-1]
 
-        # Switching to log spectrogram
-        log_spectro = 10 * np.log10(np.array(spectro))
-        del spectro
+        # The raster renderer only normalises and switches to log the pixels it samples
+        if self.renderer == 'matplotlib':
+            with span(self.profiler, 'log_scale'):
+                log_spectro = spectro / self.max_w
+                np.log10(log_spectro, out=log_spectro)
+                log_spectro *= 10
+            return self.plot_spectro(segment_times, frequencies, log_spectro)
+
+        image = self.raster_spectro(segment_times, frequencies, spectro)
+        with span(self.profiler, 'png'):
+            png_data = png_bytes(image)
+        if self.renderer == 'check':
+            log_spectro = 10 * np.log10(np.array(spectro / self.max_w))
+            self.check_raster(segment_times, frequencies, log_spectro, image, output_file)
+        return png_data
+
+    def write_output(self, output_file, png_data):
+        """Writes png_data to output_file, or adds it to self.archive when set"""
+        if self.archive is not None:
+            self.archive.add(os.path.relpath(output_file, self.archive_root), png_data)
+        else:
+            with open(output_file, 'wb') as png_file:
+                png_file.write(png_data)
+        if self.profiler is not None:
+            self.profiler.note(output_bytes=len(png_data))
+
+    def plot_spectro(self, segment_times, frequencies, log_spectro):
+        """Plots log_spectro with matplotlib pcolormesh and returns it as png data"""
+        import matplotlib.pyplot as plt
 
         # Ploting spectrogram
-        my_dpi = 100
-        fact_x = 1.3
-        fact_y = 1.3
-        fig = plt.figure(figsize=(fact_x * 1800 / my_dpi, fact_y * 512 / my_dpi), dpi=my_dpi)
-        plt.pcolormesh(segment_times, frequencies, log_spectro, cmap=self.cmap_color)
-        plt.clim(vmin=self.min_color_val, vmax=self.max_color_val)
-        plt.axis('off')
-        fig.axes[0].get_xaxis().set_visible(False)
-        fig.axes[0].get_yaxis().set_visible(False)
+        with span(self.profiler, 'pcolormesh'):
+            fig = plt.figure(figsize=(FIG_WIDTH / MY_DPI, FIG_HEIGHT / MY_DPI), dpi=MY_DPI)
+            plt.pcolormesh(segment_times, frequencies, log_spectro, cmap=self.cmap_color)
+            plt.clim(vmin=self.min_color_val, vmax=self.max_color_val)
+            plt.axis('off')
+            fig.axes[0].get_xaxis().set_visible(False)
+            fig.axes[0].get_yaxis().set_visible(False)
 
         # Saving spectrogram plot to file
-        plt.savefig(output_file, bbox_inches='tight', pad_inches=0, dpi=my_dpi)
-        fig.clear()
-        plt.close(fig)
-        del log_spectro
+        with span(self.profiler, 'savefig'):
+            png_file = io.BytesIO()
+            plt.savefig(png_file, format='png', bbox_inches='tight', pad_inches=0, dpi=MY_DPI)
+            fig.clear()
+            plt.close(fig)
+        return png_file.getvalue()
+
+    def raster_spectro(self, segment_times, frequencies, spectro):
+        """Rasterises the normalised log of spectro to the RGB image pcolormesh would give, without any matplotlib figure"""
+        width, height = int(AXES_WIDTH), int(AXES_HEIGHT)
+
+        # Picking the spectro cell under each pixel center (left/lower cell on ties), rows go from top (max frequency) to bottom
+        x_edges = quad_edges(segment_times)
+        y_edges = quad_edges(frequencies)
+        x_centers = x_edges[0] + (np.arange(width) + 0.5) * (x_edges[-1] - x_edges[0]) / AXES_WIDTH
+        y_centers = y_edges[0] + (height - np.arange(height) - 0.5) * (y_edges[-1] - y_edges[0]) / AXES_HEIGHT
+        cols = np.clip(np.searchsorted(x_edges, x_centers, side='left') - 1, 0, len(segment_times) - 1)
+        rows = np.clip(np.searchsorted(y_edges, y_centers, side='left') - 1, 0, len(frequencies) - 1)
+        with span(self.profiler, 'log_scale'):
+            pixels = 10 * np.log10(spectro[np.ix_(rows, cols)] / self.max_w)
+
+        # Applying color_val_range clim, autoscaling on finite values like matplotlib when not set
+        vmin, vmax = self.min_color_val, self.max_color_val
+        if vmin is None or vmax is None:
+            with span(self.profiler, 'autoscale'):
+                log_min, log_max = np.nan, np.nan
+                for block in self.column_blocks(spectro):
+                    log_block = spectro[:, block] / self.max_w
+                    with np.errstate(divide='ignore'):
+                        np.log10(log_block, out=log_block)
+                    log_block *= 10
+                    log_block[~np.isfinite(log_block)] = np.nan
+                    log_min = np.fmin(log_min, np.fmin.reduce(log_block, axis=None))
+                    log_max = np.fmax(log_max, np.fmax.reduce(log_block, axis=None))
+                vmin = log_min if vmin is None else vmin
+                vmax = log_max if vmax is None else vmax
+
+        with span(self.profiler, 'colormap'):
+            # Mapping through the colormap lookup table, lut[0] is the under color and lut[-1] the over color
+            cmap = matplotlib.colormaps[self.cmap_color]
+            lut = (cmap(np.arange(-1, cmap.N + 1))[:, :3] * 255 + 0.5).astype(np.uint8)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                norm = (pixels - vmin) / (vmax - vmin) if vmax != vmin else np.zeros_like(pixels)
+                norm *= cmap.N
+                norm[norm == cmap.N] = cmap.N - 1
+                # NaN cells (LTSA columns without audio) get a valid index, their pixels are whitened below
+                norm[np.isnan(norm)] = -1
+                indexes = np.clip(np.floor(norm), -1, cmap.N).astype(np.int64) + 1
+            image = lut[indexes]
+
+            # Invalid values are masked by pcolormesh and show the white figure background
+            image[~np.isfinite(pixels)] = 255
+        return image
 
-    def gen_tiles(self, tile_levels, data, sample_rate, output, equalize_spectro=True):
+    def check_raster(self, segment_times, frequencies, log_spectro, image, output_file):
+        """Prints the pixel diff between the raster image and the matplotlib render of log_spectro"""
+        import matplotlib.pyplot as plt
+
+        reference_file = io.BytesIO(self.plot_spectro(segment_times, frequencies, log_spectro))
+        reference = np.round(plt.imread(reference_file)[..., :3] * 255).astype(np.int16)
+        if reference.shape != image.shape:
+            print(f"{output_file}: raster shape {image.shape} differs from matplotlib shape {reference.shape}")
+            return
+        diff = np.abs(reference - image).max(axis=-1)
+        print(f"{output_file}: max pixel diff {diff.max()}, {100 * np.mean(diff > 0):.3f}% pixels differ")
+
+    def gen_tiles(self, tile_levels, data, sample_rate, output, equalize_spectro=True, pyramid=False):
         """Generates multiple spectrograms for zoom tiling"""
-        duration = len(data) / int(sample_rate)
-        for level in range(0, tile_levels):
-            zoom_level = 2**level
-            tile_duration = duration / zoom_level
+        if self.tile_jobs > 1:
+            self.gen_tiles_parallel(tile_levels, data, sample_rate, output, equalize_spectro, pyramid)
+            return
+        if pyramid:
+            _, frequencies, spectro = self.get_psd(data, sample_rate)
+            self.gen_tiles_pyramid(tile_levels, len(data), sample_rate, frequencies, spectro, output, equalize_spectro)
+            return
+        for level, zoom_level, tile, start, end in self.level_records(tile_slices(tile_levels, len(data), sample_rate)):
+            main_ref = equalize_spectro and (level == 0)
+            output_file = f"{output[:-4]}_{zoom_level}_{tile}.png"
+            if self.tile_done(output_file):
+                continue
+            with self.tile_record(level, zoom_level, tile, output_file, min(end, len(data)) - start):
+                self.render_tile(data, sample_rate, level, zoom_level, tile, start, end, output_file, main_ref)
+            self.tile_completed(output_file)
+
+    def render_tile(self, data, sample_rate, level, zoom_level, tile, start, end, output_file, main_ref=False):
+        """Renders the tile_slices tile of samples [start, end) of data to output_file"""
+        segment_times, frequencies, spectro = self.get_psd(data, sample_rate, start, end)
+        shorten = level > 0 and tile < zoom_level-1
+        self.render_spectro(segment_times, frequencies, spectro, output_file, main_ref=main_ref, shorten=shorten)
+
+    def gen_tiles_pyramid(self, tile_levels, nb_samples, sample_rate, frequencies, spectro, output, equalize_spectro=True):
+        """Generates zoom tiles by slicing time columns from the PSD of the whole signal of nb_samples
+
+        Tiles use the frames of the whole signal STFT that fully fit in their sample range, so frame
+        positions are snapped to the global STFT grid instead of starting exactly at each tile start.
+        """
+        for level, zoom_level, tile, start, end in self.level_records(tile_slices(tile_levels, nb_samples, sample_rate)):
             main_ref = equalize_spectro and (level == 0)
-            for tile in range(0, zoom_level):
-                start = tile * tile_duration
-                end = start + tile_duration
-                output_file = f"{output[:-4]}_{zoom_level}_{tile}.png"
-                sample_data = data[int(start * sample_rate):int((end + 1) * sample_rate)]
-                shorten = level > 0 and tile < zoom_level-1
-                self.gen_spectro(sample_data, sample_rate, output_file, main_ref=main_ref, shorten=shorten)
+            output_file = f"{output[:-4]}_{zoom_level}_{tile}.png"
+            if self.tile_done(output_file):
+                continue
+            with self.tile_record(level, zoom_level, tile, output_file, min(end, nb_samples) - start):
+                self.render_pyramid_tile(nb_samples, sample_rate, frequencies, spectro, level, zoom_level, tile, start, end, output_file, main_ref)
+            self.tile_completed(output_file)
+
+    def render_pyramid_tile(self, nb_samples, sample_rate, frequencies, spectro, level, zoom_level, tile, start, end, output_file, main_ref=False):
+        """Renders the tile_slices tile of samples [start, end) to output_file from the columns of the whole signal spectro"""
+        columns, segment_times = self.pyramid_tile_frames(nb_samples, sample_rate, start, end)
+        shorten = level > 0 and tile < zoom_level-1
+        self.render_spectro(segment_times, frequencies, spectro[:, columns], output_file, main_ref=main_ref, shorten=shorten)
+
+    def pyramid_tile_frames(self, nb_samples, sample_rate, start, end):
+        """Returns the whole signal spectro columns slice of samples [start, end) and their center times relative to start"""
+        nperseg, _, nstep = self.frame_step()
+        first, last = tile_columns(start, min(end, nb_samples), nperseg, nstep)
+        return slice(first, last), (np.arange(first, last) * nstep + nperseg / 2 - start) / float(sample_rate)
+
+    def gen_tiles_parallel(self, tile_levels, data, sample_rate, output, equalize_spectro=True, pyramid=False):
+        """Generates the tiles of gen_tiles, the ones of each level after level 0 concurrently with a TileRenderPool
+
+        Level 0 is rendered first since it sets self.max_w, tile pngs are then written in the gen_tiles order.
+        """
+        nb_samples = len(data)
+        frequencies = spectro = None
+        if pyramid:
+            _, frequencies, spectro = self.get_psd(data, sample_rate)
+
+        pool = None
+        records = self.level_records(tile_slices(tile_levels, nb_samples, sample_rate))
+        try:
+            for level in range(tile_levels):
+                # Taking exactly the tiles of level, so that its profiler record stays open while they are made
+                tiles = [(zoom_level, tile, start, end, f"{output[:-4]}_{zoom_level}_{tile}.png") for _, zoom_level, tile, start, end in itertools.islice(records, 2**level)]
+                tiles = [tile_record for tile_record in tiles if not self.tile_done(tile_record[4])]
+                if level == 0:
+                    for zoom_level, tile, start, end, output_file in tiles:
+                        with self.tile_record(level, zoom_level, tile, output_file, min(end, nb_samples) - start):
+                            if pyramid:
+                                self.render_pyramid_tile(nb_samples, sample_rate, frequencies, spectro, level, zoom_level, tile, start, end, output_file, equalize_spectro)
+                            else:
+                                self.render_tile(data, sample_rate, level, zoom_level, tile, start, end, output_file, equalize_spectro)
+                        self.tile_completed(output_file)
+                    continue
+
+                if pool is None:
+                    pool = TileRenderPool(self, self.tile_jobs, spectro)
+                if pyramid:
+                    futures = [pool.submit_pyramid_tile(nb_samples, sample_rate, frequencies, level, zoom_level, tile, start, end, output_file)
+                               for zoom_level, tile, start, end, output_file in tiles]
+                else:
+                    futures = [pool.submit_tile(data, sample_rate, level, zoom_level, tile, start, end, output_file)
+                               for zoom_level, tile, start, end, output_file in tiles]
+                for (zoom_level, tile, start, end, output_file), future in zip(tiles, futures):
+                    png_data = future.result()
+                    with self.tile_record(level, zoom_level, tile, output_file, min(end, nb_samples) - start):
+                        with span(self.profiler, 'png'):
+                            self.write_output(output_file, png_data)
+                    self.tile_completed(output_file)
+            # Closing the record of the last level
+            for _ in records:
+                pass
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def tile_done(self, output_file):
+        """Returns whether output_file was completed by a previous run according to self.manifest_job"""
+        return self.manifest_job is not None and self.manifest_job.tile_done(output_file)
+
+    def tile_completed(self, output_file):
+        """Records output_file as completed in self.manifest_job when set, archived tiles are only recorded with their job"""
+        if self.manifest_job is not None and self.archive is None:
+            self.manifest_job.complete_tile(output_file, self.max_w)
+
+    def level_records(self, slices):
+        """Returns tile_slices slices, wrapped to record each level with self.profiler when set"""
+        if self.profiler is None:
+            return slices
+        return self.profiler.level_records(slices)
+
+    def tile_record(self, level, zoom_level, tile, output_file, nb_samples):
+        """Returns the context recording a tile with self.profiler, or a no-op context when it is not set"""
+        if self.profiler is None:
+            return NULL_SPAN
+        return self.profiler.record('tile', level=level, zoom_level=zoom_level, tile=tile, output=output_file, samples=nb_samples)
+
+    def sample_blocks(self, sound_file):
+        """Returns the SampleBlocks reader of sound_file, highpass filtered when self.butter is set
+
+        With self.cache_filtered, filtered samples are read from self.psd_cache or saved to it while streaming.
+        """
+        dtype = 'float32' if self.float32 else 'float64'
+        if self.butter is None:
+            return SampleBlocks(sound_file, dtype, profiler=self.profiler)
+        if self.cache_filtered:
+            key = filtered_audio_key(self.psd_cache, self.psd_source, self.float32)
+            samples = self.psd_cache.load(key)
+            if samples is not None:
+                return SampleBlocks(sound_file, dtype, samples=samples, profiler=self.profiler)
+            sos = butter_highpass_sos(self.butter[1], sound_file.samplerate, self.butter[0])
+            return SampleBlocks(sound_file, dtype, sos, filtered_path=self.psd_cache.temp_path(key), profiler=self.profiler)
+        return SampleBlocks(sound_file, dtype, butter_highpass_sos(self.butter[1], sound_file.samplerate, self.butter[0]), profiler=self.profiler)
+
+    def stream_psd(self, sample_blocks, psd_path, window_type='hamming'):
+        """Computes the PSD of the sample_blocks audio block by block into the .npy file psd_path, keeping memory under self.max_memory
+
+        Blocks are read with the window overlap at their edges so frames are the ones of the whole signal STFT.
+        The PSD is saved as a (frames, frequencies) array with all rfft frequencies.
+        """
+        nperseg, noverlap, nstep = self.frame_step()
+        nb_samples = sample_blocks.nb_samples
+        nb_freqs = self.nfft // 2 + 1
+        nb_frames = max(0, (nb_samples - noverlap) // nstep)
+        psd = np.lib.format.open_memmap(psd_path, mode='w+', dtype=np.float32 if self.float32 else np.float64, shape=(nb_frames, nb_freqs))
+
+        block_frames = max(1, self.max_memory // self.frame_memory(nb_freqs))
+        for first in range(0, nb_frames, block_frames):
+            last = min(nb_frames, first + block_frames)
+            block = sample_blocks.read(first * nstep, (last - 1) * nstep + nperseg)
+            with span(self.profiler, 'psd'):
+                _, _, block_psd = self.compute_psd(block, sample_blocks.sample_rate, window_type, restrict=False)
+            with span(self.profiler, 'psd_write'):
+                psd[first:last] = block_psd.transpose()
+        with span(self.profiler, 'psd_write'):
+            psd.flush()
+        del psd
+
+    def streamed_psd(self, audio_file, nb_samples, tmp_dir, window_type='hamming'):
+        """Returns the memory-mapped (frames, frequencies) PSD of the nb_samples of audio_file, streamed with stream_psd
+
+        The PSD is loaded from self.psd_cache or saved to it when set, else it is written to its own file in tmp_dir,
+        so the PSDs of several files can share tmp_dir.
+        """
+        if self.psd_cache is not None:
+            key = self.psd_key(0, nb_samples, window_type)
+            with span(self.profiler, 'cache_load'):
+                psd = self.psd_cache.load(key)
+            if psd is not None:
+                return psd
+            psd_path = self.psd_cache.temp_path(key)
+        else:
+            psd_fd, psd_path = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+            os.close(psd_fd)
+        with soundfile.SoundFile(audio_file) as sound_file:
+            if sound_file.channels > 1:
+                print('WARNING: soundfile has multiple channels, taking only first one')
+            sample_blocks = self.sample_blocks(sound_file)
+            self.stream_psd(sample_blocks, psd_path, window_type)
+            if sample_blocks.filtered_path is not None:
+                sample_blocks.finish()
+                self.psd_cache.commit(filtered_audio_key(self.psd_cache, self.psd_source, self.float32), sample_blocks.filtered_path, dict(self.psd_source, kind='filtered'))
+        psd = np.load(psd_path, mmap_mode='r')
+        if self.psd_cache is not None:
+            self.psd_cache.commit(key, psd_path, dict(self.psd_source, nfft=self.nfft, win_size=self.win_size, overlap=self.pct_overlap, start=0, end=nb_samples))
+        return psd
+
+    def gen_streamed(self, tile_levels, audio_file, output, equalize_spectro=True, window_type='hamming'):
+        """Generates the spectrogram or zoom tiles of audio_file with memory bounded by self.max_memory
+
+        The PSD is kept in a memory-mapped file (a self.psd_cache entry when set), tiles are sliced out
+        of it like with gen_tiles pyramid mode.
+        """
+        if self.renderer != 'raster':
+            print(f"WARNING: {self.renderer} renderer loads whole tiles in memory, use raster renderer to bound memory")
+        info = soundfile.info(audio_file)
+        nb_samples, sample_rate = info.frames, info.samplerate
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            psd = self.streamed_psd(audio_file, nb_samples, tmp_dir, window_type)
+            segment_times, frequencies, spectro = self.psd_view(psd, nb_samples, sample_rate)
+            if tile_levels == 1:
+                with self.tile_record(0, 1, 0, output, nb_samples):
+                    self.render_spectro(segment_times, frequencies, spectro, output)
+                self.tile_completed(output)
+            else:
+                self.gen_tiles_pyramid(tile_levels, nb_samples, sample_rate, frequencies, spectro, output, equalize_spectro)
+            del psd, spectro
+
+
+class TileRenderPool:
+    """Threads computing tile PSDs from the shared samples and worker processes rendering them to png data
+
+    Tile spectros reach workers through shared memory (SharedArray) instead of being pickled. With the
+    whole signal spectro of pyramid mode, it is shared once and workers slice the columns of each tile.
+    """
+
+    def __init__(self, spectro_generator, jobs, spectro=None):
+        self.spectro_generator = spectro_generator
+        # Workers only get the rendering settings, self.max_w being already set by level 0
+        self.render_generator = copy.copy(spectro_generator)
+        for name in ['psd_cache', 'psd_source', 'profiler', 'manifest_job', 'archive']:
+            setattr(self.render_generator, name, None)
+        self.threads = ThreadPoolExecutor(max_workers=jobs)
+        # Forked workers could inherit locks held by the PSD threads
+        self.processes = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('forkserver'))
+        self.spectro = SharedArray(spectro) if spectro is not None else None
+
+    def submit_tile(self, data, sample_rate, level, zoom_level, tile, start, end, output_file):
+        """Returns the future png data of the render_tile tile of samples [start, end) of data"""
+        return self.threads.submit(self.render_tile, data, sample_rate, level, zoom_level, tile, start, end, output_file)
+
+    def render_tile(self, data, sample_rate, level, zoom_level, tile, start, end, output_file):
+        """Computes the PSD of a tile in the calling thread and returns its png data rendered by a worker process"""
+        segment_times, frequencies, spectro = self.spectro_generator.get_psd(data, sample_rate, start, end)
+        shared = SharedArray(spectro)
+        del spectro
+        try:
+            shorten = level > 0 and tile < zoom_level-1
+            return self.processes.submit(render_shared_tile, self.render_generator, shared, slice(None), segment_times, frequencies, output_file, shorten).result()
+        finally:
+            shared.unlink()
+
+    def submit_pyramid_tile(self, nb_samples, sample_rate, frequencies, level, zoom_level, tile, start, end, output_file):
+        """Returns the future png data of the render_pyramid_tile tile of samples [start, end) of the shared whole signal spectro"""
+        columns, segment_times = self.spectro_generator.pyramid_tile_frames(nb_samples, sample_rate, start, end)
+        shorten = level > 0 and tile < zoom_level-1
+        return self.processes.submit(render_shared_tile, self.render_generator, self.spectro, columns, segment_times, frequencies, output_file, shorten)
+
+    def close(self):
+        """Stops the threads and worker processes and frees the shared spectro"""
+        self.threads.shutdown(wait=True, cancel_futures=True)
+        self.processes.shutdown(wait=True, cancel_futures=True)
+        if self.spectro is not None:
+            self.spectro.unlink()
+
+
+class SharedArray:
+    """Copy of an array in shared memory, pickled as the name of the memory block so processes map it without copying"""
+
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.name = self.memory.name
+        np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)[...] = array
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype, 'name': self.name, 'memory': None}
+
+    def unlink(self):
+        """Frees the shared memory block"""
+        self.memory.close()
+        self.memory.unlink()
+
+
+def render_shared_tile(spectro_generator, shared, columns, segment_times, frequencies, output_file, shorten):
+    """Worker function of TileRenderPool, returns the png data of the columns of the SharedArray spectro"""
+    memory = shared_memory.SharedMemory(name=shared.name)
+    try:
+        spectro = np.ndarray(shared.shape, shared.dtype, buffer=memory.buf)[:, columns]
+        png_data = spectro_generator.spectro_png(segment_times, frequencies, spectro, output_file, shorten=shorten)
+        del spectro
+        return png_data
+    finally:
+        memory.close()
+
+
+class SampleBlocks:
+    """Reads [start, end) blocks of the first channel of an open SoundFile, or of already loaded samples
+
+    With sos, blocks are zero-phase highpass filtered with filter_edge samples of context on both sides.
+    With filtered_path, filtered blocks are also saved to that .npy file, finish then completes it.
+    """
+
+    def __init__(self, sound_file, dtype, sos=None, samples=None, filtered_path=None, profiler=None):
+        self.sound_file = sound_file
+        self.profiler = profiler
+        self.nb_samples = sound_file.frames
+        self.sample_rate = sound_file.samplerate
+        self.dtype = dtype
+        self.sos = sos
+        self.samples = samples
+        self.edge = filter_edge(sos) if sos is not None else 0
+        self.filtered_path = filtered_path
+        self.filtered = None
+        self.end = 0
+        if filtered_path is not None:
+            self.filtered = np.lib.format.open_memmap(filtered_path, mode='w+', dtype=dtype, shape=(self.nb_samples,))
+
+    def read(self, start, end):
+        """Returns the (filtered) samples [start, end)"""
+        if self.samples is not None:
+            with span(self.profiler, 'cache_load'):
+                return np.asarray(self.samples[start:end], dtype=self.dtype)
+        first, last = max(0, start - self.edge), min(self.nb_samples, end + self.edge)
+        with span(self.profiler, 'decode'):
+            self.sound_file.seek(first)
+            block = self.sound_file.read(last - first, dtype=self.dtype, always_2d=True)[:, 0]
+        if self.sos is not None:
+            with span(self.profiler, 'filter'):
+                block = signal.sosfiltfilt(self.sos, block)[start - first:end - first].astype(self.dtype, copy=False)
+        if self.filtered is not None:
+            with span(self.profiler, 'cache_store'):
+                self.filtered[start:end] = block
+            self.end = max(self.end, end)
+        return block
+
+    def finish(self, block_size=2**20):
+        """Filters the samples after the last read block into the filtered file and closes it"""
+        for start in range(self.end, self.nb_samples, block_size):
+            self.read(start, min(self.nb_samples, start + block_size))
+        self.filtered.flush()
+        self.filtered = None
 
 
-def butter_highpass_filter(data, cutoff, sample_rate, order):
-    """Applies highpass (above cutoff) Butterworth digital filter of given order on data"""
+class LazySamples:
+    """Audio samples whose loading is deferred until they are first sliced"""
+
+    def __init__(self, nb_samples, load):
+        self.nb_samples = nb_samples
+        self.load = load
+        self.samples = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.nb_samples
+
+    def __getitem__(self, key):
+        # Tiles of a level slice samples from several threads in parallel mode
+        with self.lock:
+            if self.samples is None:
+                self.samples = self.load()
+        return self.samples[key]
+
+
+class StageProfiler:
+    """Appends JSON-lines records of the stage timings, array sizes, peak RSS and output bytes of files, levels and tiles to log_file
+
+    Records are nested (file, level, tile), time spent in a stage span is added to every open record and
+    output bytes of a record are added to its parent.
+    """
+
+    def __init__(self, log_file, **context):
+        self.log_f = open(log_file, 'a')
+        self.context = dict(context, pid=os.getpid())
+        self.records = []
+
+    def begin(self, kind, **fields):
+        """Opens a record of kind with fields"""
+        self.records.append(dict(self.context, kind=kind, **fields, start=time.perf_counter(), stages={}, output_bytes=0))
+
+    def end(self, **fields):
+        """Closes the last opened record, updated with fields, and writes it"""
+        record = self.records.pop()
+        record.update(fields)
+        record['time'] = time.perf_counter() - record.pop('start')
+        record['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if record['kind'] == 'tile' and os.path.exists(record['output']):
+            record['output_bytes'] = os.path.getsize(record['output'])
+        if self.records:
+            self.records[-1]['output_bytes'] += record['output_bytes']
+        self.log_f.write(json.dumps(record) + '\n')
+        self.log_f.flush()
+
+    @contextlib.contextmanager
+    def record(self, kind, **fields):
+        """Context recording kind with fields"""
+        self.begin(kind, **fields)
+        try:
+            yield
+        finally:
+            self.end()
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Context adding its duration to stage in every open record"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            for record in self.records:
+                record['stages'][stage] = record['stages'].get(stage, 0) + duration
+
+    def note(self, **fields):
+        """Adds fields to the last opened record"""
+        if self.records:
+            self.records[-1].update(fields)
+
+    def level_records(self, slices):
+        """Yields tile_slices slices, recording each level"""
+        level = None
+        for tile_slice in slices:
+            if tile_slice[0] != level:
+                if level is not None:
+                    self.end()
+                level = tile_slice[0]
+                self.begin('level', level=level, zoom_level=tile_slice[1])
+            yield tile_slice
+        if level is not None:
+            self.end()
+
+    def close(self):
+        """Writes the records left open and closes log_file"""
+        while self.records:
+            self.end()
+        self.log_f.close()
+
+
+NULL_SPAN = contextlib.nullcontext()
+
+def span(profiler, stage):
+    """Returns the stage span context of profiler, or a no-op context when profiler is None"""
+    if profiler is None:
+        return NULL_SPAN
+    return profiler.span(stage)
+
+def frequency_mask(frequencies, min_freq=None, max_freq=None):
+    """Returns the boolean mask of frequencies within [min_freq, max_freq], unset bounds are ignored"""
+    freqs_to_keep = (frequencies == frequencies)
+    if min_freq:
+        freqs_to_keep *= min_freq <= frequencies
+    if max_freq:
+        freqs_to_keep *= frequencies <= max_freq
+    return freqs_to_keep
+
+def frequency_slice(frequencies, min_freq=None, max_freq=None):
+    """Returns the slice of sorted frequencies within [min_freq, max_freq], unset bounds are ignored"""
+    freqs_to_keep = np.flatnonzero(frequency_mask(frequencies, min_freq, max_freq))
+    return slice(freqs_to_keep[0], freqs_to_keep[-1] + 1) if len(freqs_to_keep) else slice(0, 0)
+
+def tile_slices(tile_levels, nb_samples, sample_rate):
+    """Yields (level, zoom_level, tile, start, end) sample bounds of every tile of the zoom pyramid"""
+    duration = nb_samples / int(sample_rate)
+    for level in range(0, tile_levels):
+        zoom_level = 2**level
+        tile_duration = duration / zoom_level
+        for tile in range(0, zoom_level):
+            start = tile * tile_duration
+            end = start + tile_duration
+            yield level, zoom_level, tile, int(start * sample_rate), int((end + 1) * sample_rate)
+
+def tile_columns(start, end, nperseg, nstep):
+    """Returns (first, last) indexes of the whole signal STFT frames fully contained in samples [start, end)"""
+    first = -(-start // nstep)
+    last = max(first, (end - nperseg) // nstep + 1)
+    return first, last
+
+def quad_edges(centers):
+    """Returns the cell edges pcolormesh uses around centers (midpoints, extended by half a step at both ends)"""
+    centers = np.asarray(centers, dtype=float)
+    if len(centers) == 1:
+        return np.array([centers[0], centers[0]])
+    half_steps = np.diff(centers) / 2
+    return np.concatenate(([centers[0] - half_steps[0]], centers[:-1] + half_steps, [centers[-1] + half_steps[-1]]))
+
+def png_bytes(image, compress_level=6):
+    """Returns an (height, width, 3) uint8 RGB image as png data"""
+    height, width, _ = image.shape
+    raw = np.zeros((height, 1 + 3 * width), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, -1)
+
+    def chunk(tag, content):
+        return struct.pack('>I', len(content)) + tag + content + struct.pack('>I', zlib.crc32(tag + content))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b''.join([b'\x89PNG\r\n\x1a\n', chunk(b'IHDR', header), chunk(b'IDAT', zlib.compress(raw.tobytes(), compress_level)), chunk(b'IEND', b'')])
+
+def butter_highpass_sos(cutoff, sample_rate, order):
+    """Returns the second-order sections of the highpass (above cutoff) Butterworth digital filter of given order"""
     normal_cutoff = cutoff / (0.5 * sample_rate)
-    numerator, denominator = signal.butter(order, normal_cutoff, btype='high', analog=False)
-    return signal.filtfilt(numerator, denominator, data)
+    return signal.butter(order, normal_cutoff, btype='high', analog=False, output='sos')
 
-def main():
-    """Main script function"""
-    args = PARSER.parse_args()
+@functools.lru_cache(maxsize=None)
+def _filter_edge(sos_bytes, nb_sections, tolerance):
+    sos = np.frombuffer(sos_bytes).reshape(nb_sections, 6).copy()
+    length = 1024
+    while True:
+        impulse = np.zeros(length)
+        impulse[0] = 1
+        response = np.abs(signal.sosfilt(sos, impulse))
+        above = np.flatnonzero(response > tolerance * response.max())
+        if above[-1] < length // 2 or length >= 2**24:
+            return int(above[-1]) + 1
+        length *= 2
 
-    if args.audio_file[-4:].lower() != '.wav':
-        raise ValueError('Input audio file should have .wav extension')
+def filter_edge(sos, tolerance=1e-12):
+    """Returns the number of samples after which the sos filter impulse response stays below tolerance of its peak
 
-    if args.output is None:
-        args.output = args.audio_file[:-4] + '.png'
+    It is the context needed on both sides of a block to filter it forward and backward like the whole signal.
+    """
+    sos = np.ascontiguousarray(sos, dtype=np.float64)
+    return _filter_edge(sos.tobytes(), len(sos), tolerance)
 
-    data, sample_rate = soundfile.read(args.audio_file)
-    if len(data.shape) > 1:
-        if len(data.shape) > 2:
-            raise Exception(f"Soundfile data shape should have only one dimension and not be {data.shape}")
-        print('WARNING: soundfile has multiple channels, taking only first one')
-        data = data[:, 0]
+def butter_highpass_filter(data, cutoff, sample_rate, order, block_size=None):
+    """Applies highpass (above cutoff) Butterworth digital filter of given order on data
+
+    The filter runs forward and backward (zero phase) in second-order sections. With block_size, data is
+    filtered block by block with filter_edge samples of context on both sides to bound temporaries.
+    """
+    sos = butter_highpass_sos(cutoff, sample_rate, order)
+    dtype = np.result_type(data.dtype, np.float32)
+    if block_size is None or block_size >= len(data):
+        return signal.sosfiltfilt(sos, data).astype(dtype, copy=False)
+
+    edge = filter_edge(sos)
+    filtered = np.empty(len(data), dtype=dtype)
+    for start in range(0, len(data), block_size):
+        end = min(len(data), start + block_size)
+        first, last = max(0, start - edge), min(len(data), end + edge)
+        filtered[start:end] = signal.sosfiltfilt(sos, data[first:last])[start - first:end - first]
+    return filtered
+
+def filtered_audio_key(psd_cache, psd_source, float32=False):
+    """Returns the psd_cache key of the filtered samples of psd_source"""
+    return psd_cache.key(kind='filtered', source=psd_source, dtype='float32' if float32 else 'float64')
+
+@functools.lru_cache(maxsize=None)
+def get_window(window_type, nperseg):
+    """Returns the STFT window, cached so it is built once per process"""
+    return signal.get_window(window_type, nperseg)
 
+def make_spectro_generator(args):
+    """Returns the SpectroGenerator set up from parsed args"""
     freq_plot_range = Range(args.freq_plot_range) if args.freq_plot_range else None
     freq_dyn_range = Range(args.freq_dyn_range) if args.freq_dyn_range else None
     color_val_range = Range(args.color_val_range) if args.color_val_range else None
-
-    # Applying highpass Butterworth digital filter
-    if args.butter_order:
-        butter_cutoff = 0
-        if freq_dyn_range and freq_dyn_range.min:
-            butter_cutoff = freq_dyn_range.min
-        elif freq_plot_range and freq_plot_range.min:
-            butter_cutoff = freq_plot_range.min
-        data = butter_highpass_filter(data, butter_cutoff, sample_rate, args.butter_order)
+    max_memory = int(args.max_memory * 2**20) if args.max_memory else None
 
     spectro_generator = SpectroGenerator(
         args.nfft,
@@ -203,18 +1025,310 @@ def main():
         args.cmap_color,
         freq_plot_range,
         freq_dyn_range,
-        color_val_range
+        color_val_range,
+        args.renderer,
+        max_memory,
+        args.float32,
+        args.fft_threads
     )
-
-    equalize_spectro = True
     if args.max_bgw:
         spectro_generator.max_w = args.max_bgw
-        equalize_spectro = False
+    # Streamed tiles are rendered one at a time to bound memory
+    if not max_memory:
+        spectro_generator.tile_jobs = max(1, args.tile_jobs)
+    return spectro_generator
+
+def parse_param_set(string):
+    """Returns the dict of args overrides of a parameter set string like 'nfft=2048 winsize=512 overlap=90 cvr=-90:0'"""
+    overrides = {}
+    for item in string.split():
+        key, _, value = item.partition('=')
+        if key not in PARAM_SET_KEYS or value == '':
+            raise ValueError(f"Parameter set items should be KEY=VALUE with KEY in {list(PARAM_SET_KEYS)}, not {item}")
+        name, cast = PARAM_SET_KEYS[key]
+        overrides[name] = cast(value)
+    return overrides
 
-    if args.tile_levels == 1:
-        spectro_generator.gen_spectro(data, sample_rate, args.output)
+def param_set_args(args):
+    """Returns the list of (args, subfolder) of each --params set, or [(args, None)] without parameter sets"""
+    if not args.params:
+        return [(args, None)]
+    return [(argparse.Namespace(**dict(vars(args), **parse_param_set(params))), params) for params in args.params]
+
+def butter_cutoff(args):
+    """Returns the highpass Butterworth filter cutoff from the dynamic or plot frequency range"""
+    freq_plot_range = Range(args.freq_plot_range) if args.freq_plot_range else None
+    freq_dyn_range = Range(args.freq_dyn_range) if args.freq_dyn_range else None
+    if freq_dyn_range and freq_dyn_range.min:
+        return freq_dyn_range.min
+    if freq_plot_range and freq_plot_range.min:
+        return freq_plot_range.min
+    return 0
+
+def read_audio(args, audio_file, psd_cache=None, psd_source=None, profiler=None):
+    """Returns the first channel samples of audio_file, highpass filtered when args.butter_order is set
+
+    With psd_cache and args.cache_filtered, filtered samples are loaded from or saved to psd_cache.
+    """
+    cache_key = None
+    if args.butter_order and args.cache_filtered and psd_cache is not None:
+        cache_key = filtered_audio_key(psd_cache, psd_source, args.float32)
+        with span(profiler, 'cache_load'):
+            data = psd_cache.load(cache_key)
+        if data is not None:
+            return data
+
+    with span(profiler, 'decode'):
+        data, sample_rate = soundfile.read(audio_file, dtype='float32' if args.float32 else 'float64')
+    if len(data.shape) > 1:
+        if len(data.shape) > 2:
+            raise Exception(f"Soundfile data shape should have only one dimension and not be {data.shape}")
+        print('WARNING: soundfile has multiple channels, taking only first one')
+        data = data[:, 0]
+
+    # Applying highpass Butterworth digital filter
+    if args.butter_order:
+        block_size = int(args.filter_block * sample_rate) if args.filter_block else None
+        with span(profiler, 'filter'):
+            data = butter_highpass_filter(data, butter_cutoff(args), sample_rate, args.butter_order, block_size).astype(data.dtype, copy=False)
+        if cache_key is not None:
+            with span(profiler, 'cache_store'):
+                psd_cache.store(cache_key, data, dict(psd_source, kind='filtered'))
+    return data
+
+def gen_file(args, audio_file, output):
+    """Generates the spectro or zoom tiles of audio_file to output with parsed args settings"""
+    if audio_file[-4:].lower() != '.wav':
+        raise ValueError('Input audio file should have .wav extension')
+    if args.cache_filtered and not args.psd_cache:
+        raise ValueError('Filtered audio is cached in the PSD cache, --cache-filtered needs --psd-cache')
+    if args.archive and not os.path.dirname(output):
+        raise ValueError('Tiles are archived as the output folder, --archive needs an output within a folder')
+
+    psd_cache = psd_source = None
+    if args.psd_cache:
+        psd_cache = PSDCache(args.psd_cache, int(args.psd_cache_size * 2**20))
+        psd_source = {
+            'audio': psd_cache.file_hash(audio_file),
+            'butter_order': args.butter_order,
+            'butter_cutoff': butter_cutoff(args) if args.butter_order else None
+        }
+
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(args.profile, file=audio_file)
+
+    # Audio is decoded and filtered once for all parameter sets, and only if some PSD is not cached
+    info = soundfile.info(audio_file)
+    data = LazySamples(info.frames, lambda: read_audio(args, audio_file, psd_cache, psd_source, profiler))
+
+    if profiler is not None:
+        profiler.begin('file', samples=info.frames, sample_rate=info.samplerate, channels=info.channels)
+    manifest = RunManifest(args.manifest) if args.manifest else None
+    stats = None
+    if args.stats:
+        # Imported here since spectro_stats.py imports this script
+        from spectro_stats import read_stats
+        stats = read_stats(args.stats)
+    # Tiles of every parameter set go to the archive of the output folder, as tar czf of its content would
+    archive = None
+    if args.archive:
+        archive = TileArchive(os.path.dirname(output) + COMPRESSIONS[args.archive], args.archive, args.archive_level)
+    try:
+        gen_param_sets(args, audio_file, output, info, data, psd_cache, psd_source, profiler, manifest, archive, stats)
+    except BaseException:
+        if archive is not None:
+            archive.abort()
+        raise
     else:
-        spectro_generator.gen_tiles(args.tile_levels, data, sample_rate, args.output, equalize_spectro)
+        if archive is not None:
+            # An archive left untouched when the manifest skipped every set
+            if archive.index:
+                archive.close()
+            else:
+                archive.abort()
+    finally:
+        if profiler is not None:
+            profiler.close()
+        if manifest is not None:
+            manifest.close()
+
+def gen_param_sets(args, audio_file, output, info, data, psd_cache, psd_source, profiler, manifest, archive=None, stats=None):
+    """Generates the spectros of every parameter set of args from the shared audio data of gen_file"""
+    param_sets = []
+    for set_args, subfolder in param_set_args(args):
+        if stats is not None:
+            from spectro_stats import normalised_args
+            set_args = normalised_args(stats, set_args)
+        set_output = output
+        if subfolder is not None:
+            set_output = os.path.join(os.path.dirname(output), subfolder, os.path.basename(output))
+        manifest_job = None
+        if manifest is not None:
+            settings = {name: getattr(set_args, name) for name in MANIFEST_ARGS}
+            settings['streamed'] = bool(set_args.max_memory)
+            manifest_job = manifest.job(audio_file, set_output, settings, set_args.tile_levels)
+        param_sets.append((set_args, subfolder, set_output, manifest_job))
+
+    # An archive is rewritten as a whole, so all sets are made again unless they are all up to date
+    if archive is not None and not all(manifest_job is not None and manifest_job.done for _, _, _, manifest_job in param_sets):
+        for _, _, _, manifest_job in param_sets:
+            if manifest_job is not None:
+                manifest_job.done = False
+                manifest_job.tiles = {}
+
+    for set_args, subfolder, set_output, manifest_job in param_sets:
+        if manifest_job is not None and manifest_job.done:
+            print(f"Skipping {set_output}, spectros are up to date in manifest")
+            continue
+
+        if subfolder is not None and archive is None:
+            os.makedirs(os.path.dirname(set_output) or '.', exist_ok=True)
+
+        spectro_generator = make_spectro_generator(set_args)
+        if psd_cache is not None:
+            spectro_generator.psd_cache = psd_cache
+            spectro_generator.psd_source = psd_source
+            spectro_generator.cache_filtered = args.cache_filtered
+        if args.butter_order:
+            spectro_generator.butter = (args.butter_order, butter_cutoff(args))
+        if profiler is not None:
+            spectro_generator.profiler = profiler
+            profiler.context['params'] = subfolder
+        if archive is not None:
+            spectro_generator.archive = archive
+            spectro_generator.archive_root = os.path.dirname(output)
+        equalize_spectro = not set_args.max_bgw
+        if manifest_job is not None:
+            spectro_generator.manifest_job = manifest_job
+            # Resumed tiles are normalised like the main tile rendered by the interrupted run
+            if equalize_spectro and manifest_job.max_w is not None:
+                spectro_generator.max_w = manifest_job.max_w
+
+        if spectro_generator.max_memory:
+            spectro_generator.gen_streamed(set_args.tile_levels, audio_file, set_output, equalize_spectro)
+        elif set_args.tile_levels == 1:
+            spectro_generator.gen_spectro(data, info.samplerate, set_output)
+        else:
+            spectro_generator.gen_tiles(set_args.tile_levels, data, info.samplerate, set_output, equalize_spectro, set_args.pyramid)
+        if manifest_job is not None:
+            manifest_job.finish()
+
+def batch_files(path):
+    """Returns the wav files of a folder, or the files listed one per line in a text file"""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, filename) for filename in os.listdir(path) if filename.lower().endswith('.wav'))
+    with open(path, 'r') as list_file:
+        return [line.strip() for line in list_file if line.strip()]
+
+def batch_output(audio_file, output_folder, make_folder=True):
+    """Returns the png output filepath of audio_file in batch mode, creating its folder when make_folder"""
+    name = os.path.basename(audio_file)[:-4]
+    folder = os.path.join(os.path.dirname(audio_file), output_folder.format(name=name))
+    if make_folder:
+        os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, name + '.png')
+
+def available_memory():
+    """Returns the memory (in bytes) currently available on the machine"""
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+def batch_job(args, audio_file):
+    """Worker function of batch mode, returns the error traceback of audio_file or None"""
+    try:
+        output = batch_output(audio_file, args.output or '{name}', make_folder=not args.archive)
+        print(f"Making spectros for {audio_file} in {os.path.dirname(output) + COMPRESSIONS[args.archive] if args.archive else 'folder ' + os.path.dirname(output)}", flush=True)
+        gen_file(args, audio_file, output)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+def run_batch(args):
+    """Processes the batch files with a persistent pool of workers, running as many jobs as memory allows
+
+    Each job memory is estimated from the file frame count and the STFT settings, a job bigger than
+    the whole budget runs alone. A worker killed (e.g. out of memory) breaks the pool: it is then
+    restarted and the files that were running are retried alone. Returns the dict of failed files and their error.
+    """
+    audio_files = batch_files(args.audio_file)
+    jobs = max(1, args.jobs)
+    budget = int(args.batch_memory * 2**20) if args.batch_memory else available_memory()
+    spectro_generators = [make_spectro_generator(set_args) for set_args, _ in param_set_args(args)]
+    estimates = {}
+    for audio_file in audio_files:
+        try:
+            nb_samples = soundfile.info(audio_file).frames
+        except Exception:
+            nb_samples = 0  # Unreadable files fail in their job and get reported
+        # Highpass filtering needs a few full length float64 temporaries
+        filter_memory = 0
+        if args.butter_order and not args.max_memory:
+            filter_memory = 8 * nb_samples if args.filter_block else 4 * 8 * nb_samples
+        estimates[audio_file] = max(generator.memory_estimate(nb_samples) for generator in spectro_generators) + filter_memory
+        if estimates[audio_file] > budget:
+            print(f"WARNING: {audio_file} needs about {estimates[audio_file] // 2**20}MB, over the {budget // 2**20}MB budget, consider --max-memory")
+
+    failures = {}
+    pending = list(audio_files)
+    alone = set()
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        while pending or running:
+            used = sum(estimates[audio_file] for audio_file in running.values())
+            for audio_file in list(pending):
+                if len(running) >= jobs or any(running_file in alone for running_file in running.values()):
+                    break
+                if running and (audio_file in alone or used + estimates[audio_file] > budget):
+                    continue
+                pending.remove(audio_file)
+                running[executor.submit(batch_job, args, audio_file)] = audio_file
+                used += estimates[audio_file]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                audio_file = running.pop(future)
+                try:
+                    error = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    if len(done) + len(running) > 1 and audio_file not in alone:
+                        alone.add(audio_file)
+                        pending.insert(0, audio_file)
+                        continue
+                    error = traceback.format_exc()
+                except Exception:
+                    error = traceback.format_exc()
+                if error:
+                    failures[audio_file] = error
+                    print(f"FAILED {audio_file}:\n{error}", flush=True)
+            if broken:
+                # Every running job was lost with the pool
+                for audio_file in running.values():
+                    alone.add(audio_file)
+                    pending.insert(0, audio_file)
+                running = {}
+                executor.shutdown(wait=True)
+                executor = ProcessPoolExecutor(max_workers=jobs)
+    finally:
+        executor.shutdown(wait=True)
+
+    print(f"Processed {len(audio_files) - len(failures)}/{len(audio_files)} files successfully")
+    return failures
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+
+    if args.batch:
+        if run_batch(args):
+            sys.exit(1)
+        return
+
+    if args.output is None:
+        args.output = args.audio_file[:-4] + '.png'
+
+    gen_file(args, args.audio_file, args.output)
 
 if __name__ == '__main__':
     main()
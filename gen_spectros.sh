@@ -5,44 +5,55 @@
 export GEN_SPECTRO_PATH=gen_spectro.py
 # Tiling level 6 makes for a x32 zoom, level 5 is x16 and so on
 export TILING_LEVEL=6
-# How many cores on machine to parallelize calculations (be careful about RAM consumption as well)
+# Spectro parameter sets, each one is made from a single reading of the audio file in its own folder.
+# Sets without mw or cvr get the dataset-wide max_bgw and color_val_range of spectro_stats.py
+PARAM_SETS=("nfft=2048 winsize=512 overlap=90")
+export STATS_PATH=spectro_stats.py
+STATS=spectros_stats.json
+# Maximum number of worker processes, jobs are also limited by available memory (see --batch-memory)
 CORES=5
+# Records what was made from which wav content and settings, so finished spectros are skipped and interrupted ones resumed
+MANIFEST=spectros_manifest.sqlite
+# Tiles are streamed into a <wav name>.tgz archive instead of a folder (gz, or zst for .tar.zst)
+ARCHIVE=gz
 
-# make_spectros(audio_file, nfft, winsize, overlap)
-function make_spectros() {
-  basename=${1%.*}
-  folder=$basename/nfft=$2\ winsize=$3\ overlap=$4\ cvr=$6;
-  mkdir -p "$folder";
-  echo "Making spectros for $1 in folder $folder"
-  python3 $GEN_SPECTRO_PATH -t $TILING_LEVEL -w $3 -n $2 -o $4 -mw $5 -cvr=$6 $1 "$folder/$1";
-}
-export -f make_spectros
+params=();
+for param_set in "${PARAM_SETS[@]}"; do
+  params+=(--params "$param_set");
+done
 
-# make_zip(folder_name)
-function make_zip() {
-  cd $1;
-  tar -cvzf ../$1.tgz *;
-  cd ..;
-  rm -rf $1;
+# make_stats(list_file), statistics of unchanged files are kept in $STATS
+function make_stats() {
+  python3 $STATS_PATH -j $CORES "${params[@]}" -o $STATS $1;
 }
-export -f make_zip
 
-# process_wave(wave_filename)
-function process_wave() {
-  make_spectros $1 2048 512 90 1 "-90:0" >> spectros.log;
-  basename=${1%.*};
-  make_zip $basename;
+# make_spectros(list_file)
+function make_spectros() {
+  python3 $GEN_SPECTRO_PATH --batch -j $CORES -t $TILING_LEVEL --stats $STATS --manifest $MANIFEST --archive $ARCHIVE "${params[@]}" $1 "{name}";
 }
-export -f process_wave
 
-# Find next files to process thanks to a ruby one liner that returns all wave files that don't have a tgz
-next_waves=$(ruby -e "puts %x{ls *.wav}.split - %x{ls *.tgz}.split.map{|fn| fn.gsub('.tgz','.wav')}")
+# All wave files are given to the batch, the manifest skips the ones whose spectros are up to date.
+# Without a manifest yet, a ruby one liner returns all wave files that don't have a tgz
+if [ -f $MANIFEST ]
+then
+  next_waves=$(ls *.wav 2>/dev/null)
+else
+  next_waves=$(ruby -e "puts %x{ls *.wav}.split - %x{ls *.tgz}.split.map{|fn| fn.gsub('.tgz','.wav')}")
+fi
 if [ -z "$next_waves" ]
 then
-  echo "No unprocessed wav files found"
+  echo "No wav files found"
 else
-  echo "We will now start processing `echo $next_waves | wc -w` files using $CORES cores"
+  echo "We will now check `echo $next_waves | wc -w` files and process the new or changed ones using up to $CORES cores"
+
+  # DATASET-WIDE NORMALISATION FROM ALL WAVE FILES, A CHANGE OF IT MAKES THE MANIFEST REDO EVERY SPECTRO
+  ls *.wav > all_waves.txt
+  make_stats all_waves.txt >> spectros.log 2>&1;
 
-  # RUN SPECTROS CALCULATIONS ON NEXT WAVES FILES USING https://www.gnu.org/software/parallel/
-  echo "$next_waves" | parallel --nice 10 -j $CORES process_wave
+  # RUN SPECTROS CALCULATIONS ON NEXT WAVES FILES IN A SINGLE BATCH OF PERSISTENT WORKERS
+  echo "$next_waves" > next_waves.txt
+  make_spectros next_waves.txt > batch.log 2>&1;
+  cat batch.log >> spectros.log;
+  grep "^Processed" batch.log
+  rm -f all_waves.txt next_waves.txt batch.log
 fi
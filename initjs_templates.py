@@ -24,6 +24,14 @@ del_insert = """.then(() => {
     })
     """
 
+del_copy = """.then(() => {
+        return knex('$table').del();
+    })
+    .then(() => {
+        return knex.raw("COPY $table ($columns) FROM '$path' WITH (FORMAT csv, HEADER true, NULL '\\\\N')");
+    })
+    """
+
 single_raw_sql = 'knex.raw("$sql")'
 
 raw_sql = """
@@ -0,0 +1,376 @@
+#!/bin/python3
+"""
+Dataset-wide long-term spectral average (LTSA): PSD columns averaged at a fixed time resolution over all wav files of
+dataset_files.csv, stored as an appendable on-disk array and rendered as one zoomable tile pyramid
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import shlex
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+import soundfile
+
+import gen_spectro
+from gen_dataset_files import TIME_FORMAT
+
+
+PARSER = argparse.ArgumentParser(description='Script that averages the PSD of the wav files of a dataset at a fixed time resolution into an appendable LTSA array, and renders it as one tile pyramid')
+PARSER.add_argument('dataset_files', help='dataset_files.csv giving the audio_start of every wav file')
+PARSER.add_argument('output', nargs='?', default='ltsa', help='Folder of the LTSA array, its index and tiles, files already in it are not recomputed (default ltsa)')
+PARSER.add_argument('--audio-folder', type=str, default=None, help='Folder of the wav files (default the dataset_files.csv folder)')
+PARSER.add_argument('--resolution', '-res', type=float, default=10, help='Duration (in s) averaged into each LTSA column (default 10)')
+PARSER.add_argument('--spectro-args', type=str, default='', help='gen_spectro.py arguments of the PSD and its rendering (nfft, win_size, overlap, frequency ranges, butter order, float32, max memory, colors, max bgw, renderer)')
+PARSER.add_argument('--tile-levels', '-tl', type=int, default=6, help='Number of tile levels of the LTSA pyramid (default 6)')
+PARSER.add_argument('--name', type=str, default='ltsa', help='Tiles are named {name}_{zoom}_{tile}.png (default ltsa)')
+PARSER.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of files averaged in parallel')
+PARSER.add_argument('--rebuild', action='store_true', help='Recomputes the LTSA of every file from scratch')
+
+INDEX_FILE = 'ltsa.json'
+# Previous values of the rows a file being added changes
+JOURNAL_FILE = 'ltsa_journal.npz'
+# Averaged PSD (columns, frequencies) float32 rows and frame count int64 of each column of an array generation,
+# columns without frames count 0
+PSD_FILE = 'ltsa_psd.{}.f32'
+COUNTS_FILE = 'ltsa_counts.{}.i64'
+ARRAY_PREFIXES = ('ltsa_psd.', 'ltsa_counts.')
+# Spectro args the stored PSD depends on, a change of them needs a rebuild
+LTSA_ARGS = ['nfft', 'win_size', 'overlap', 'freq_plot_range', 'butter_order', 'float32']
+# Spectro args the tiles depend on, a change of them only re-renders
+RENDER_ARGS = ['freq_dyn_range', 'color_val_range', 'cmap_color', 'max_bgw', 'renderer']
+# Memory (in bytes) of the audio and PSD blocks when --max-memory is not set
+BLOCK_MEMORY = 64 * 2**20
+EPOCH = datetime(1970, 1, 1)
+
+
+def read_dataset_files(csv_file):
+    """Returns the (filename, audio_start in ns since epoch) of dataset_files.csv rows sorted by audio_start"""
+    with open(csv_file, 'r') as csv_f:
+        rows = list(csv.DictReader(csv_f, skipinitialspace=True))
+    files = []
+    for row in rows:
+        audio_start = datetime.strptime(row['audio_start'].strip('"'), TIME_FORMAT)
+        files.append((row['filename'], (audio_start - EPOCH) // timedelta(microseconds=1) * 1000))
+    return sorted(files, key=lambda file: file[1])
+
+def file_columns(spectro_args, audio_file, start_ns, resolution_ns):
+    """Worker function returning (sample_rate, first_column, means, counts) of the PSD of audio_file averaged by LTSA column
+
+    Frames go to the column of their center time, columns being resolution_ns steps since epoch. Audio is streamed
+    block by block so memory stays within the --max-memory spectro arg, or BLOCK_MEMORY.
+    """
+    spectro_generator = gen_spectro.make_spectro_generator(spectro_args)
+    if spectro_args.butter_order:
+        spectro_generator.butter = (spectro_args.butter_order, gen_spectro.butter_cutoff(spectro_args))
+    nperseg, noverlap, nstep = spectro_generator.frame_step()
+
+    with soundfile.SoundFile(audio_file) as sound_file:
+        sample_rate = sound_file.samplerate
+        frequencies = np.fft.rfftfreq(spectro_generator.nfft, 1 / sample_rate)
+        nb_freqs = len(frequencies[gen_spectro.frequency_slice(frequencies, spectro_generator.min_freq_plot, spectro_generator.max_freq_plot)])
+        nb_frames = max(0, (sound_file.frames - noverlap) // nstep)
+        if nb_frames == 0:
+            return sample_rate, 0, np.zeros((0, nb_freqs), dtype=np.float32), np.zeros(0, dtype=np.int64)
+
+        centers = start_ns + np.round((np.arange(nb_frames) * nstep + nperseg / 2) * 1e9 / sample_rate).astype(np.int64)
+        columns = centers // resolution_ns
+        first_column = int(columns[0])
+        columns -= first_column
+        counts = np.bincount(columns)
+        sums = np.zeros((len(counts), nb_freqs))
+
+        sample_blocks = spectro_generator.sample_blocks(sound_file)
+        block_frames = max(1, (spectro_generator.max_memory or BLOCK_MEMORY) // spectro_generator.frame_memory(nb_freqs))
+        for first in range(0, nb_frames, block_frames):
+            last = min(nb_frames, first + block_frames)
+            block = sample_blocks.read(first * nstep, (last - 1) * nstep + nperseg)
+            _, _, block_psd = spectro_generator.compute_psd(block, sample_rate)
+            # Block frames are summed by runs of the same column
+            block_columns = columns[first:last]
+            runs = np.flatnonzero(np.diff(block_columns, prepend=-1))
+            sums[block_columns[runs]] += np.add.reduceat(block_psd, runs, axis=1).transpose()
+
+    with np.errstate(invalid='ignore'):
+        means = np.where(counts[:, None] > 0, sums / counts[:, None], 0)
+    return sample_rate, first_column, means.astype(np.float32), counts
+
+def file_columns_job(spectro_args, audio_file, start_ns, resolution_ns):
+    """Worker function returning (file_columns, None), or (None, error traceback) when audio_file fails"""
+    try:
+        return file_columns(spectro_args, audio_file, start_ns, resolution_ns), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class LTSAArray:
+    """Time ordered LTSA columns of a folder, row i averaging the frames of the resolution step first_column + i since epoch
+
+    PSD and counts are raw memory-mapped files grown in place when files are appended after the last column, and
+    copied to a new generation of files with the existing columns shifted when files come before the first one.
+    The JSON index gives their generation, extent and the files they hold. Rows of the indexed generation are only
+    changed once their previous values are saved to a journal, which undoes them when a run dies before the index
+    lists the file, so a rerun never counts a file twice.
+    """
+
+    def __init__(self, folder, settings):
+        self.folder = folder
+        self.index_file = os.path.join(folder, INDEX_FILE)
+        self.journal_file = os.path.join(folder, JOURNAL_FILE)
+        try:
+            with open(self.index_file, 'r') as index_f:
+                self.index = json.load(index_f)
+        except FileNotFoundError:
+            self.index = {'settings': settings, 'sample_rate': None, 'nb_freqs': None, 'generation': 0, 'first_column': 0, 'nb_columns': 0, 'files': {}, 'rendered': None}
+        if self.index['settings'] != settings:
+            raise ValueError(f"{self.index_file} was made with settings {self.index['settings']}, not {settings}, use --rebuild or another output folder")
+        self.recover()
+
+    @property
+    def first_column(self):
+        return self.index['first_column']
+
+    @property
+    def nb_columns(self):
+        return self.index['nb_columns']
+
+    def array_files(self, generation=None):
+        """Returns the (psd, counts) file paths of generation, the indexed one when None"""
+        generation = self.index['generation'] if generation is None else generation
+        return os.path.join(self.folder, PSD_FILE.format(generation)), os.path.join(self.folder, COUNTS_FILE.format(generation))
+
+    def arrays(self, mode='r', generation=None, nb_columns=None):
+        """Returns the memory-mapped (psd, counts) arrays of generation, the indexed one when None"""
+        psd_file, counts_file = self.array_files(generation)
+        shape = (self.nb_columns if nb_columns is None else nb_columns, self.index['nb_freqs'])
+        return np.memmap(psd_file, dtype=np.float32, mode=mode, shape=shape), np.memmap(counts_file, dtype=np.int64, mode=mode, shape=shape[:1])
+
+    def recover(self):
+        """Undoes the rows changed by a file the index does not list, and removes the files of other generations"""
+        if os.path.exists(self.journal_file):
+            with np.load(self.journal_file) as journal:
+                if int(journal['generation']) == self.index['generation'] and str(journal['filename']) not in self.index['files']:
+                    psd, counts = self.arrays('r+')
+                    rows = slice(int(journal['start']), int(journal['start']) + len(journal['counts']))
+                    psd[rows] = journal['psd']
+                    counts[rows] = journal['counts']
+                    psd.flush()
+                    counts.flush()
+                    del psd, counts
+            os.remove(self.journal_file)
+        current = set(os.path.basename(path) for path in self.array_files())
+        for filename in os.listdir(self.folder):
+            if filename.startswith(ARRAY_PREFIXES) and filename not in current:
+                os.remove(os.path.join(self.folder, filename))
+
+    def extend(self, first, last):
+        """Returns (generation, first_column, nb_columns) of arrays covering the current columns and [first, last)
+
+        Arrays of a new generation are made when there are no columns yet or when first is before the first column,
+        the current ones are grown in place otherwise, the rows past the indexed ones being zeros (columns without frames).
+        """
+        if self.nb_columns == 0:
+            new_first, new_last = first, last
+        else:
+            new_first = min(first, self.first_column)
+            new_last = max(last, self.first_column + self.nb_columns)
+        row_bytes = 4 * self.index['nb_freqs']
+        if self.nb_columns and new_first == self.first_column:
+            # Rows past the indexed ones may hold the merge of a run that died, truncating first zeroes them
+            for path, item_bytes in zip(self.array_files(), [row_bytes, 8]):
+                with open(path, 'r+b') as array_f:
+                    array_f.truncate(self.nb_columns * item_bytes)
+                    array_f.truncate((new_last - new_first) * item_bytes)
+            return self.index['generation'], new_first, new_last - new_first
+
+        generation = self.index['generation'] + 1
+        shift = self.first_column - new_first
+        for path, new_path, item_bytes in zip(self.array_files(), self.array_files(generation), [row_bytes, 8]):
+            with open(new_path, 'wb') as new_f:
+                new_f.truncate((new_last - new_first) * item_bytes)
+                if not self.nb_columns:
+                    continue
+                new_f.seek(shift * item_bytes)
+                with open(path, 'rb') as array_f:
+                    for _ in range(0, self.nb_columns * item_bytes, BLOCK_MEMORY):
+                        new_f.write(array_f.read(BLOCK_MEMORY))
+        return generation, new_first, new_last - new_first
+
+    def add(self, filename, file_entry, sample_rate, first_column, means, counts):
+        """Merges the averaged columns of a file and commits the index listing it
+
+        Columns it shares with adjacent files are weighted by frame counts.
+        """
+        if self.index['sample_rate'] is not None and sample_rate != self.index['sample_rate']:
+            raise ValueError(f"{filename} sample rate {sample_rate} differs from the LTSA sample rate {self.index['sample_rate']}")
+        self.index['sample_rate'] = sample_rate
+        self.index['nb_freqs'] = means.shape[1]
+        old_generation = self.index['generation']
+        if len(counts):
+            generation, new_first, nb_columns = self.extend(first_column, first_column + len(counts))
+            psd, ltsa_counts = self.arrays('r+', generation, nb_columns)
+            rows = slice(first_column - new_first, first_column - new_first + len(counts))
+            if generation == old_generation:
+                # Previous values of the indexed rows, the ones past them being zeros
+                journal_rows = slice(rows.start, min(rows.stop, self.nb_columns))
+                temp_file = f"{self.journal_file}.{os.getpid()}.tmp"
+                with open(temp_file, 'wb') as journal_f:
+                    np.savez(journal_f, generation=generation, filename=filename, start=journal_rows.start,
+                             psd=psd[journal_rows], counts=ltsa_counts[journal_rows])
+                os.replace(temp_file, self.journal_file)
+            total = ltsa_counts[rows] + counts
+            with np.errstate(invalid='ignore'):
+                merged = (psd[rows] * ltsa_counts[rows, None] + means * counts[:, None]) / total[:, None]
+            psd[rows] = np.where(total[:, None] > 0, merged, 0)
+            ltsa_counts[rows] = total
+            psd.flush()
+            ltsa_counts.flush()
+            del psd, ltsa_counts
+            self.index.update(generation=generation, first_column=new_first, nb_columns=nb_columns)
+        self.index['files'][filename] = dict(file_entry, first_column=first_column, nb_columns=len(counts))
+        self.commit()
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        if self.index['generation'] != old_generation:
+            for path in self.array_files(old_generation):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def commit(self):
+        """Writes the index"""
+        temp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as index_f:
+            json.dump(self.index, index_f)
+        os.replace(temp_file, self.index_file)
+
+    def column_blocks(self, first, last, block_columns):
+        """Yields (start, psd, counts) blocks of at most block_columns columns of array rows [first, last)"""
+        psd, counts = self.arrays()
+        for start in range(first, last, block_columns):
+            end = min(last, start + block_columns)
+            yield start, np.asarray(psd[start:end], dtype=np.float64), np.asarray(counts[start:end])
+
+    def block_columns(self, factor=1):
+        """Returns the number of columns of blocks fitting BLOCK_MEMORY as float64 copies, a multiple of factor"""
+        return max(1, BLOCK_MEMORY // (3 * 8 * factor * max(1, self.index['nb_freqs']))) * factor
+
+    def reduced(self, first, last, factor):
+        """Returns (centers in columns relative to first, (frequencies, columns) spectro) of array rows [first, last) averaged by factor columns
+
+        Columns without frames are NaN, the ones of the last reduced column may be fewer than factor.
+        """
+        starts = np.arange(first, last, factor)
+        spectro = np.empty((self.index['nb_freqs'], len(starts)))
+        for start, psd, counts in self.column_blocks(first, last, self.block_columns(factor)):
+            groups = np.arange(0, len(counts), factor)
+            weights = np.add.reduceat(counts, groups)
+            with np.errstate(invalid='ignore'):
+                means = np.add.reduceat(psd * counts[:, None], groups, axis=0) / weights[:, None]
+            spectro[:, (start - first) // factor:(start - first) // factor + len(groups)] = np.where(weights[:, None] > 0, means, np.nan).transpose()
+        return (starts + np.minimum(starts + factor, last)) / 2 - first, spectro
+
+
+def frequencies(spectro_generator, sample_rate):
+    """Returns the frequencies of the LTSA rows, the plot range of the rfft frequencies"""
+    rfft_frequencies = np.fft.rfftfreq(spectro_generator.nfft, 1 / sample_rate)
+    return rfft_frequencies[gen_spectro.frequency_slice(rfft_frequencies, spectro_generator.min_freq_plot, spectro_generator.max_freq_plot)]
+
+def normalise(spectro_generator, ltsa, row_frequencies, max_bgw=None):
+    """Sets max_w (unless max_bgw) and the unset color range bounds of spectro_generator over the whole LTSA"""
+    freqs_to_keep = gen_spectro.frequency_mask(row_frequencies, spectro_generator.min_freq_dyn, spectro_generator.max_freq_dyn)
+    if not max_bgw:
+        spectro_generator.max_w = max((np.amax(psd[counts > 0][:, freqs_to_keep], initial=0) for _, psd, counts in ltsa.column_blocks(0, ltsa.nb_columns, ltsa.block_columns())), default=0) or 1
+    # Tiles share the color range instead of autoscaling each on its own columns
+    if spectro_generator.min_color_val is None or spectro_generator.max_color_val is None:
+        log_min, log_max = np.inf, -np.inf
+        for _, psd, counts in ltsa.column_blocks(0, ltsa.nb_columns, ltsa.block_columns()):
+            with np.errstate(divide='ignore'):
+                log_block = 10 * np.log10(psd[counts > 0] / spectro_generator.max_w)
+            log_block = log_block[np.isfinite(log_block)]
+            if log_block.size:
+                log_min, log_max = min(log_min, log_block.min()), max(log_max, log_block.max())
+        if spectro_generator.min_color_val is None:
+            spectro_generator.min_color_val = float(log_min) if np.isfinite(log_min) else 0
+        if spectro_generator.max_color_val is None:
+            spectro_generator.max_color_val = float(log_max) if np.isfinite(log_max) else 0
+
+def render_tiles(spectro_args, ltsa, tile_levels, name, resolution):
+    """Renders the LTSA pyramid, tile of level l covering 1/2**l of all columns averaged down to the png width"""
+    spectro_generator = gen_spectro.make_spectro_generator(spectro_args)
+    row_frequencies = frequencies(spectro_generator, ltsa.index['sample_rate'])
+    normalise(spectro_generator, ltsa, row_frequencies, spectro_args.max_bgw)
+    for level in range(tile_levels):
+        zoom_level = 2**level
+        for tile in range(zoom_level):
+            first = min(tile * ltsa.nb_columns // zoom_level, ltsa.nb_columns - 1)
+            last = max(first + 1, (tile + 1) * ltsa.nb_columns // zoom_level)
+            factor = math.ceil((last - first) / int(gen_spectro.AXES_WIDTH))
+            centers, spectro = ltsa.reduced(first, last, factor)
+            output_file = os.path.join(ltsa.folder, f"{name}_{zoom_level}_{tile}.png")
+            spectro_generator.render_spectro(centers * resolution, row_frequencies, spectro, output_file)
+    return spectro_generator
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    spectro_args = gen_spectro.PARSER.parse_args(['ltsa.wav'] + shlex.split(args.spectro_args))
+    audio_folder = args.audio_folder or os.path.dirname(args.dataset_files)
+    resolution_ns = round(args.resolution * 1e9)
+    settings = dict({name: getattr(spectro_args, name) for name in LTSA_ARGS}, resolution_ns=resolution_ns)
+
+    os.makedirs(args.output, exist_ok=True)
+    if args.rebuild:
+        for filename in os.listdir(args.output):
+            if filename in (INDEX_FILE, JOURNAL_FILE) or filename.startswith(ARRAY_PREFIXES):
+                os.remove(os.path.join(args.output, filename))
+    ltsa = LTSAArray(args.output, settings)
+
+    # Files already averaged are kept as they are, the others are averaged in parallel and merged in time order
+    pending = []
+    for filename, start_ns in read_dataset_files(args.dataset_files):
+        audio_file = os.path.join(audio_folder, filename)
+        if not os.path.exists(audio_file):
+            print(f"WARNING: {audio_file} of {args.dataset_files} not found, skipping it")
+            continue
+        stat = os.stat(audio_file)
+        file_entry = {'audio_start_ns': start_ns, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        known = ltsa.index['files'].get(filename)
+        if known is None:
+            pending.append((filename, audio_file, file_entry))
+        elif (known['audio_start_ns'], known['mtime_ns'], known['size']) != (start_ns, stat.st_mtime_ns, stat.st_size):
+            print(f"WARNING: {filename} changed since it was averaged, its LTSA columns are kept, use --rebuild to recompute them")
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        jobs = executor.map(file_columns_job, [spectro_args] * len(pending), [audio_file for _, audio_file, _ in pending],
+                            [file_entry['audio_start_ns'] for _, _, file_entry in pending], [resolution_ns] * len(pending))
+        for (filename, audio_file, file_entry), (columns, error) in zip(pending, jobs):
+            if error is None:
+                try:
+                    ltsa.add(filename, file_entry, *columns)
+                except ValueError:
+                    error = traceback.format_exc()
+            if error:
+                failures += 1
+                print(f"FAILED {audio_file}:\n{error}", flush=True)
+                continue
+            print(f"Averaged {filename} into {ltsa.index['files'][filename]['nb_columns']} LTSA columns", flush=True)
+
+    if ltsa.nb_columns:
+        rendered = dict({name: getattr(spectro_args, name) for name in RENDER_ARGS}, tile_levels=args.tile_levels, name=args.name,
+                        first_column=ltsa.first_column, nb_columns=ltsa.nb_columns, nb_files=len(ltsa.index['files']))
+        if rendered != ltsa.index['rendered']:
+            render_tiles(spectro_args, ltsa, args.tile_levels, args.name, args.resolution)
+            ltsa.index['rendered'] = rendered
+            ltsa.commit()
+            print(f"Rendered {2**args.tile_levels - 1} tiles of {ltsa.nb_columns} LTSA columns to {args.output}")
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
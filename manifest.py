@@ -0,0 +1,164 @@
+#!/bin/python3
+"""
+SQLite manifest of gen_spectro.py runs, to skip finished spectros and resume interrupted tile pyramids
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from psd_cache import content_hash
+
+
+PARSER = argparse.ArgumentParser(description='Script that lists or forgets the jobs of a gen_spectro run manifest')
+PARSER.add_argument('manifest_file', help='Path to the SQLite manifest file')
+PARSER.add_argument('--forget', type=str, nargs='+', default=None, help='Forgets the jobs of these audio files so they are made again')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    audio_file TEXT NOT NULL,
+    output TEXT NOT NULL,
+    audio_hash TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    tile_levels INTEGER NOT NULL,
+    max_w REAL,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (audio_file, output)
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    job_id INTEGER NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    output_file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (job_id, output_file)
+);
+"""
+
+
+class RunManifest:
+    """Jobs (an audio file rendered to an output with some settings) and their completed tiles
+
+    A job whose audio content or settings changed is reset, other jobs of the same audio file are kept.
+    Concurrent batch workers share the file through SQLite locking.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def file_hash(self, audio_file):
+        """Returns the content hash of audio_file, memoised by path, mtime and size"""
+        path = os.path.abspath(audio_file)
+        stat = os.stat(path)
+        row = self.connection.execute('SELECT hash FROM hashes WHERE path = ? AND mtime_ns = ? AND size = ?', (path, stat.st_mtime_ns, stat.st_size)).fetchone()
+        if row is not None:
+            return row[0]
+        audio_hash = content_hash(path)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)', (path, stat.st_mtime_ns, stat.st_size, audio_hash))
+        return audio_hash
+
+    def job(self, audio_file, output, settings, tile_levels):
+        """Returns the ManifestJob rendering audio_file to output with settings (a JSON serialisable dict)
+
+        Completed tiles are kept when only tile_levels changed since they do not depend on it.
+        """
+        audio_file, output = os.path.abspath(audio_file), os.path.abspath(output)
+        audio_hash = self.file_hash(audio_file)
+        settings = json.dumps(settings, sort_keys=True)
+        with self.connection:
+            row = self.connection.execute('SELECT id, audio_hash, settings, tile_levels, max_w, status FROM jobs WHERE audio_file = ? AND output = ?', (audio_file, output)).fetchone()
+            if row is None:
+                cursor = self.connection.execute('INSERT INTO jobs (audio_file, output, audio_hash, settings, tile_levels, status, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                                 (audio_file, output, audio_hash, settings, tile_levels, 'running', time.time()))
+                return ManifestJob(self, cursor.lastrowid, None, False)
+
+            job_id, old_hash, old_settings, old_tile_levels, max_w, status = row
+            if old_hash != audio_hash or old_settings != settings:
+                self.connection.execute('DELETE FROM tiles WHERE job_id = ?', (job_id,))
+                max_w = None
+            done = status == 'done' and old_hash == audio_hash and old_settings == settings and old_tile_levels == tile_levels
+            self.connection.execute('UPDATE jobs SET audio_hash = ?, settings = ?, tile_levels = ?, max_w = ?, status = ?, updated = ? WHERE id = ?',
+                                    (audio_hash, settings, tile_levels, max_w, 'done' if done else 'running', time.time(), job_id))
+        return ManifestJob(self, job_id, max_w, done)
+
+    def jobs(self):
+        """Returns the list of (audio_file, output, tile_levels, status, completed tiles, updated) of every job"""
+        return self.connection.execute('SELECT audio_file, output, tile_levels, status, COUNT(output_file), updated FROM jobs LEFT JOIN tiles ON tiles.job_id = jobs.id '
+                                       'GROUP BY jobs.id ORDER BY audio_file, output').fetchall()
+
+    def forget(self, audio_file):
+        """Removes the jobs of audio_file"""
+        with self.connection:
+            self.connection.execute('DELETE FROM jobs WHERE audio_file = ?', (os.path.abspath(audio_file),))
+
+    def close(self):
+        """Closes the manifest database"""
+        self.connection.close()
+
+
+class ManifestJob:
+    """A job of a RunManifest, max_w being the normalisation of its already rendered main tile if any"""
+
+    def __init__(self, manifest, job_id, max_w, done):
+        self.manifest = manifest
+        self.job_id = job_id
+        self.max_w = max_w
+        self.done = done
+        rows = manifest.connection.execute('SELECT output_file, size FROM tiles WHERE job_id = ?', (job_id,)).fetchall()
+        self.tiles = dict(rows)
+
+    def tile_done(self, output_file):
+        """Returns whether output_file was completed by a previous run and is still on disk"""
+        size = self.tiles.get(os.path.abspath(output_file))
+        try:
+            return size is not None and os.path.getsize(output_file) == size
+        except OSError:
+            return False
+
+    def complete_tile(self, output_file, max_w=None):
+        """Records output_file as completed, with the max_w normalisation it was rendered with"""
+        output_file = os.path.abspath(output_file)
+        self.tiles[output_file] = os.path.getsize(output_file)
+        with self.manifest.connection:
+            self.manifest.connection.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?)', (self.job_id, output_file, self.tiles[output_file]))
+            if max_w is not None and max_w != self.max_w:
+                self.max_w = float(max_w)
+                self.manifest.connection.execute('UPDATE jobs SET max_w = ? WHERE id = ?', (self.max_w, self.job_id))
+
+    def finish(self):
+        """Records the job as done, later runs then skip it even once its outputs are archived"""
+        self.done = True
+        with self.manifest.connection:
+            self.manifest.connection.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ?', ('done', time.time(), self.job_id))
+
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    manifest = RunManifest(args.manifest_file)
+
+    if args.forget:
+        for audio_file in args.forget:
+            manifest.forget(audio_file)
+        return
+
+    jobs = manifest.jobs()
+    for audio_file, output, tile_levels, status, nb_tiles, updated in jobs:
+        print(f"{status:8} {nb_tiles:5}/{2**tile_levels - 1 if tile_levels > 1 else 1:<5} {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated))} {audio_file} -> {output}")
+    print(f"{len(jobs)} jobs, {sum(job[3] == 'done' for job in jobs)} done")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/bin/python3
+"""
+On-disk LRU cache of PSD matrices for gen_spectro.py
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+
+PARSER = argparse.ArgumentParser(description='Script that lists or clears a gen_spectro PSD cache folder')
+PARSER.add_argument('cache_folder', help='Path to the PSD cache folder')
+PARSER.add_argument('--clear', action='store_true', help='Removes every cache entry')
+
+
+def content_hash(path):
+    """Returns the blake2b hex digest of the content of the file at path"""
+    file_hash = hashlib.blake2b()
+    with open(path, 'rb') as file_f:
+        for chunk in iter(lambda: file_f.read(2**20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class PSDCache:
+    """PSD matrices stored as memory-mappable .npy files, evicting least recently used entries over max_size bytes
+
+    Every entry is written to a temporary file then renamed, so concurrent batch workers can share a cache folder.
+    Entry access times are tracked with the .npy files mtime.
+    """
+
+    def __init__(self, folder, max_size=None):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(os.path.join(folder, 'hashes'), exist_ok=True)
+
+    def file_hash(self, audio_file):
+        """Returns the content hash of audio_file, memoised by path, mtime and size"""
+        stat = os.stat(audio_file)
+        path_key = hashlib.sha256(os.path.abspath(audio_file).encode()).hexdigest()
+        memo_file = os.path.join(self.folder, 'hashes', path_key + '.json')
+        try:
+            with open(memo_file, 'r') as memo_f:
+                memo = json.load(memo_f)
+            if memo['mtime_ns'] == stat.st_mtime_ns and memo['size'] == stat.st_size:
+                return memo['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        memo = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'hash': content_hash(audio_file)}
+        self.write_json(memo_file, memo)
+        return memo['hash']
+
+    @staticmethod
+    def key(**params):
+        """Returns the entry key of params"""
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def entry_path(self, key):
+        """Returns the .npy filepath of the entry key"""
+        return os.path.join(self.folder, key + '.npy')
+
+    def temp_path(self, key):
+        """Returns a process unique temporary .npy filepath to write the entry key to"""
+        return os.path.join(self.folder, f"{key}.{os.getpid()}.tmp.npy")
+
+    def load(self, key):
+        """Returns the memory-mapped PSD of entry key, or None if it is not cached"""
+        path = self.entry_path(key)
+        try:
+            psd = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return psd
+
+    def store(self, key, psd, metadata=None):
+        """Saves psd as entry key and evicts old entries as needed"""
+        temp_path = self.temp_path(key)
+        np.save(temp_path, psd)
+        self.commit(key, temp_path, metadata)
+
+    def commit(self, key, temp_path, metadata=None):
+        """Moves an entry written to temp_path into the cache and evicts old entries as needed"""
+        self.write_json(os.path.join(self.folder, key + '.json'), dict(metadata or {}, created=time.time()))
+        os.replace(temp_path, self.entry_path(key))
+        self.evict(keep=key)
+
+    def entries(self):
+        """Returns the list of (key, size, last_access, metadata) of cache entries, least recently used first"""
+        entries = []
+        for filename in os.listdir(self.folder):
+            if not filename.endswith('.npy') or filename.endswith('.tmp.npy'):
+                continue
+            key = filename[:-4]
+            try:
+                stat = os.stat(self.entry_path(key))
+            except OSError:
+                continue
+            try:
+                with open(os.path.join(self.folder, key + '.json'), 'r') as metadata_f:
+                    metadata = json.load(metadata_f)
+            except (OSError, ValueError):
+                metadata = {}
+            entries.append((key, stat.st_size, stat.st_mtime, metadata))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the cache fits in max_size, keep is never removed"""
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total_size = sum(entry[1] for entry in entries)
+        for key, size, _, _ in entries:
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total_size -= size
+
+    def remove(self, key):
+        """Removes entry key from the cache"""
+        for path in [self.entry_path(key), os.path.join(self.folder, key + '.json')]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Removes every cache entry and memoised content hash"""
+        for key, _, _, _ in self.entries():
+            self.remove(key)
+        hashes_folder = os.path.join(self.folder, 'hashes')
+        for filename in os.listdir(hashes_folder):
+            os.remove(os.path.join(hashes_folder, filename))
+
+    @staticmethod
+    def write_json(path, content):
+        """Atomically writes content as JSON to path"""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as json_f:
+            json.dump(content, json_f)
+        os.replace(temp_path, path)
+
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    cache = PSDCache(args.cache_folder)
+
+    if args.clear:
+        cache.clear()
+        return
+
+    entries = cache.entries()
+    for key, size, last_access, metadata in entries:
+        params = ' '.join(f"{name}={str(value)[:16]}" for name, value in sorted(metadata.items()) if name != 'created')
+        print(f"{key[:16]} {size / 2**20:10.1f}MB {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_access))} {params}")
+    print(f"{len(entries)} entries, {sum(entry[1] for entry in entries) / 2**20:.1f}MB")
+
+if __name__ == '__main__':
+    main()
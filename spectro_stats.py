@@ -0,0 +1,197 @@
+#!/bin/python3
+"""
+Dataset-wide spectro normalisation (max_bgw and color_val_range) from mergeable per-file PSD statistics, read by gen_spectro.py --stats
+"""
+
+import argparse
+import json
+import os
+import shlex
+import tempfile
+import traceback
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import soundfile
+
+import gen_spectro
+from psd_cache import PSDCache
+
+
+PARSER = argparse.ArgumentParser(description='Script that computes the PSD statistics of wav files in parallel and merges them into dataset-wide gen_spectro.py max_bgw and color_val_range')
+PARSER.add_argument('audio_files', help='Folder of wav files or text file listing them, like gen_spectro.py --batch')
+PARSER.add_argument('--output', '-o', type=str, default='spectro_stats.json', help='JSON stats file, statistics of unchanged files are kept from it (default spectro_stats.json)')
+PARSER.add_argument('--spectro-args', type=str, default='', help='gen_spectro.py arguments of the spectros (nfft, win_size, overlap, frequency ranges, butter order, float32, max memory, psd cache)')
+PARSER.add_argument('--params', '-ps', action='append', default=None, help='gen_spectro.py parameter set, can be repeated to make the statistics of each set from a single audio decoding')
+PARSER.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of files processed in parallel')
+PARSER.add_argument('--max-percentile', type=float, default=100, help='Percentile of the dataset PSD within freq_dyn_range used as max_bgw (default 100, the maximum like gen_spectro level 0)')
+PARSER.add_argument('--low-percentile', type=float, default=1, help='Percentile of the dataset PSD within freq_dyn_range used as color_val_range min (default 1)')
+PARSER.add_argument('--high-percentile', type=float, default=100, help='Percentile of the dataset PSD within freq_dyn_range used as color_val_range max (default 100)')
+
+# Args the PSD within freq_dyn_range depends on, a parameter set statistics are keyed by their values
+STATS_ARGS = ['nfft', 'win_size', 'overlap', 'freq_plot_range', 'freq_dyn_range', 'butter_order', 'float32']
+# Histogram bins of 10 log10(PSD), values out of range are counted in the first or last bin
+HISTOGRAM_MIN = -400
+HISTOGRAM_STEP = 0.1
+HISTOGRAM_BINS = 6000
+
+
+def stats_key(set_args):
+    """Returns the key of the statistics of parsed gen_spectro.py set_args"""
+    # Numbers are keyed as floats since parameter sets and defaults may give 0 or 0.0
+    values = {name: getattr(set_args, name) for name in STATS_ARGS}
+    return json.dumps({name: float(value) if type(value) in (int, float) else value for name, value in values.items()}, sort_keys=True)
+
+def psd_stats(spectro_generator, frequencies, spectro):
+    """Returns the mergeable statistics (maximum, value count and histogram of 10 log10) of spectro within the generator freq_dyn_range"""
+    freqs_to_keep = gen_spectro.frequency_mask(frequencies, spectro_generator.min_freq_dyn, spectro_generator.max_freq_dyn)
+    maximum = 0.0
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for block in spectro_generator.column_blocks(spectro):
+        values = np.asarray(spectro[freqs_to_keep, block], dtype=np.float64)
+        if values.size == 0:
+            continue
+        maximum = max(maximum, float(np.amax(values)))
+        with np.errstate(divide='ignore'):
+            log_values = 10 * np.log10(values[values > 0])
+        bins = np.clip(((log_values - HISTOGRAM_MIN) / HISTOGRAM_STEP).astype(np.int64), 0, HISTOGRAM_BINS - 1)
+        histogram += np.bincount(bins, minlength=HISTOGRAM_BINS)
+    nonzero = np.flatnonzero(histogram)
+    first, last = (int(nonzero[0]), int(nonzero[-1]) + 1) if len(nonzero) else (0, 0)
+    # Histograms are stored trimmed to their non-empty bins
+    return {'max': maximum, 'count': int(histogram.sum()), 'first_bin': first, 'counts': histogram[first:last].tolist()}
+
+def merge_stats(stats_list):
+    """Returns the dataset statistics merged from the psd_stats of several files, with a full histogram"""
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    maximum = 0.0
+    for stats in stats_list:
+        maximum = max(maximum, stats['max'])
+        histogram[stats['first_bin']:stats['first_bin'] + len(stats['counts'])] += stats['counts']
+    return {'max': maximum, 'histogram': histogram}
+
+def percentile(merged, percent):
+    """Returns the percent percentile of 10 log10(PSD) of merged statistics, to the histogram bin resolution"""
+    if percent >= 100 or not merged['histogram'].any():
+        return 10 * np.log10(merged['max']) if merged['max'] > 0 else HISTOGRAM_MIN
+    cumulative = np.cumsum(merged['histogram'])
+    index = int(np.searchsorted(cumulative, percent / 100 * cumulative[-1], side='left'))
+    return HISTOGRAM_MIN + (index + 1) * HISTOGRAM_STEP
+
+def dataset_normalisation(merged, max_percentile=100, low_percentile=1, high_percentile=100):
+    """Returns the max_bgw and color_val_range (relative to max_bgw, in dB) of merged statistics"""
+    max_db = percentile(merged, max_percentile)
+    low, high = percentile(merged, low_percentile) - max_db, percentile(merged, high_percentile) - max_db
+    return {'max_bgw': float(10**(max_db / 10)), 'color_val_range': f"{round(low, 2)}:{round(high, 2)}"}
+
+def file_stats(spectro_args, audio_file):
+    """Worker function returning the psd_stats of audio_file by stats_key of every parameter set of spectro_args"""
+    psd_cache = psd_source = None
+    if spectro_args.psd_cache:
+        psd_cache = PSDCache(spectro_args.psd_cache, int(spectro_args.psd_cache_size * 2**20))
+        psd_source = {
+            'audio': psd_cache.file_hash(audio_file),
+            'butter_order': spectro_args.butter_order,
+            'butter_cutoff': gen_spectro.butter_cutoff(spectro_args) if spectro_args.butter_order else None
+        }
+    info = soundfile.info(audio_file)
+    # Audio is decoded and filtered once for all parameter sets, like in gen_spectro.py
+    data = gen_spectro.LazySamples(info.frames, lambda: gen_spectro.read_audio(spectro_args, audio_file, psd_cache, psd_source))
+
+    file_sets = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for set_args, _ in gen_spectro.param_set_args(spectro_args):
+            spectro_generator = gen_spectro.make_spectro_generator(set_args)
+            if psd_cache is not None:
+                spectro_generator.psd_cache = psd_cache
+                spectro_generator.psd_source = psd_source
+            if set_args.butter_order:
+                spectro_generator.butter = (set_args.butter_order, gen_spectro.butter_cutoff(set_args))
+            if spectro_generator.max_memory:
+                psd = spectro_generator.streamed_psd(audio_file, info.frames, tmp_dir)
+                _, frequencies, spectro = spectro_generator.psd_view(psd, info.frames, info.samplerate)
+            else:
+                _, frequencies, spectro = spectro_generator.get_psd(data, info.samplerate)
+            file_sets[stats_key(set_args)] = psd_stats(spectro_generator, frequencies, spectro)
+            del spectro
+    return file_sets
+
+def file_stats_job(spectro_args, audio_file):
+    """Worker function returning (file_stats, None), or (None, error traceback) when audio_file fails"""
+    try:
+        return file_stats(spectro_args, audio_file), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def read_stats(stats_file):
+    """Returns the content of a stats file, empty when it does not exist"""
+    try:
+        with open(stats_file, 'r') as stats_f:
+            return json.load(stats_f)
+    except FileNotFoundError:
+        return {'files': {}, 'datasets': {}}
+
+def set_normalisation(stats, set_args):
+    """Returns the dataset normalisation of stats matching the PSD settings of parsed gen_spectro.py set_args"""
+    key = stats_key(set_args)
+    if key not in stats['datasets']:
+        raise ValueError(f"Stats file has no dataset normalisation for {key}, run spectro_stats.py with these spectro settings")
+    return stats['datasets'][key]
+
+def normalised_args(stats, set_args):
+    """Returns set_args with the max_bgw and color_val_range of stats, unless they were already set"""
+    normalisation = set_normalisation(stats, set_args)
+    overrides = {}
+    if not set_args.max_bgw:
+        overrides['max_bgw'] = normalisation['max_bgw']
+    if not set_args.color_val_range:
+        overrides['color_val_range'] = normalisation['color_val_range']
+    return Namespace(**dict(vars(set_args), **overrides))
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    spectro_args = gen_spectro.PARSER.parse_args(['stats.wav'] + shlex.split(args.spectro_args) + sum((['--params', params] for params in args.params or []), []))
+    audio_files = gen_spectro.batch_files(args.audio_files)
+    set_keys = [stats_key(set_args) for set_args, _ in gen_spectro.param_set_args(spectro_args)]
+
+    # Files whose content (mtime and size) and settings did not change keep their statistics
+    stats = read_stats(args.output)
+    pending = []
+    for audio_file in audio_files:
+        path = os.path.abspath(audio_file)
+        stat = os.stat(path)
+        file_entry = stats['files'].get(path)
+        if file_entry is None or (file_entry['mtime_ns'], file_entry['size']) != (stat.st_mtime_ns, stat.st_size):
+            stats['files'][path] = file_entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sets': {}}
+        if any(key not in file_entry['sets'] for key in set_keys):
+            pending.append(audio_file)
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        for audio_file, (file_sets, error) in zip(pending, executor.map(file_stats_job, [spectro_args] * len(pending), pending)):
+            if error:
+                failures += 1
+                print(f"FAILED {audio_file}:\n{error}", flush=True)
+                continue
+            stats['files'][os.path.abspath(audio_file)]['sets'].update(file_sets)
+            print(f"Computed statistics of {audio_file}", flush=True)
+
+    paths = [os.path.abspath(audio_file) for audio_file in audio_files]
+    for key in set_keys:
+        file_stats_list = [stats['files'][path]['sets'][key] for path in paths if key in stats['files'][path]['sets']]
+        if not file_stats_list:
+            raise ValueError(f"No file statistics for {key}")
+        normalisation = dataset_normalisation(merge_stats(file_stats_list), args.max_percentile, args.low_percentile, args.high_percentile)
+        stats['datasets'][key] = dict(normalisation, files=len(file_stats_list), percentiles=[args.max_percentile, args.low_percentile, args.high_percentile])
+        print(f"{key}: max_bgw {normalisation['max_bgw']:.6g}, color_val_range {normalisation['color_val_range']} from {len(file_stats_list)} files")
+
+    temp_file = f"{args.output}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as stats_f:
+        json.dump(stats, stats_f)
+    os.replace(temp_file, args.output)
+    if failures:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
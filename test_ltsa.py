@@ -0,0 +1,120 @@
+"""
+Tests of ltsa.py, incremental builds against a full build of the same dataset
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import ltsa
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+LTSA_ARGS = ['--resolution', '7', '--spectro-args', '-n 256 -w 256 -o 50', '--tile-levels', '3', '--jobs', '1']
+# Runs ltsa.py with the index commit number CRASH_AT killing the process, after the arrays were changed
+CRASHING_RUN = """
+import os, sys
+import ltsa
+commit = ltsa.LTSAArray.commit
+calls = []
+def dying_commit(self):
+    calls.append(None)
+    if len(calls) == int(os.environ['CRASH_AT']):
+        os._exit(3)
+    commit(self)
+ltsa.LTSAArray.commit = dying_commit
+sys.argv = ['ltsa.py'] + sys.argv[1:]
+ltsa.main()
+"""
+
+
+@pytest.fixture
+def dataset(tmp_path, write_wav):
+    """Writes 8 wav files, contiguous but for a gap after the fifth, and returns the dataset_files.csv rows"""
+    start = datetime(2021, 3, 1, 12)
+    rows = []
+    for i in range(8):
+        duration = 20 + i
+        filename = write_wav(tmp_path / f"glider_{i:02d}.wav", duration, sample_rate=4000, frequency=300 + 200 * i, seed=i)
+        file_start = start + timedelta(seconds=21 * i + (60 if i >= 5 else 0))
+        rows.append(f"DS,{os.path.basename(filename)},{file_start:%Y-%m-%d %H:%M:%S},{file_start + timedelta(seconds=duration):%Y-%m-%d %H:%M:%S},4.0")
+    return rows
+
+def write_csv(path, rows):
+    """Writes dataset_files.csv rows to path and returns it"""
+    path.write_text('\n'.join(['dataset_name,filename,audio_start,audio_end,audio_sample_rate_khz'] + rows) + '\n')
+    return str(path)
+
+def run_ltsa(csv_file, output, audio_folder, crash_at=None):
+    """Runs ltsa.py, killed at the crash_at index commit when set, and returns its return code"""
+    command = [sys.executable, os.path.join(SCRIPTS, 'ltsa.py')] if crash_at is None else [sys.executable, '-c', CRASHING_RUN]
+    environment = dict(os.environ, CRASH_AT=str(crash_at))
+    process = subprocess.Popen(command + [csv_file, str(output), '--audio-folder', str(audio_folder)] + LTSA_ARGS, cwd=SCRIPTS,
+                               env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    returncode = process.wait(timeout=300)
+    # Worker processes of a killed run are killed too
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return returncode
+
+def load(output):
+    """Returns (index, psd, counts) of the LTSA of output"""
+    with open(output / ltsa.INDEX_FILE) as index_f:
+        index = json.load(index_f)
+    array = ltsa.LTSAArray(str(output), index['settings'])
+    psd, counts = array.arrays()
+    return index, np.array(psd), np.array(counts)
+
+def assert_same_ltsa(output, reference):
+    """Asserts the LTSA of output has the columns and tiles of reference"""
+    index, psd, counts = load(output)
+    reference_index, reference_psd, reference_counts = load(reference)
+    assert (index['first_column'], index['nb_columns']) == (reference_index['first_column'], reference_index['nb_columns'])
+    assert sorted(index['files']) == sorted(reference_index['files'])
+    assert np.array_equal(counts, reference_counts)
+    assert np.array_equal(psd, reference_psd)
+    tiles = sorted(name for name in os.listdir(reference) if name.endswith('.png'))
+    assert len(tiles) == 7
+    for name in tiles:
+        assert (output / name).read_bytes() == (reference / name).read_bytes(), name
+    assert not os.path.exists(output / ltsa.JOURNAL_FILE)
+    assert sorted(name for name in os.listdir(output) if name.startswith(ltsa.ARRAY_PREFIXES)) == \
+        sorted(os.path.basename(path) for path in ltsa.LTSAArray(str(output), index['settings']).array_files())
+
+def test_columns_average_frames(tmp_path, dataset):
+    csv_file = write_csv(tmp_path / 'dataset_files.csv', dataset)
+    assert run_ltsa(csv_file, tmp_path / 'full', tmp_path) == 0
+    index, psd, counts = load(tmp_path / 'full')
+    # 7 s columns of 128 sample frames at 4 kHz, a gap of 60 s has columns without frames
+    assert counts.max() == 7 * 4000 // 128 + 1
+    assert (counts == 0).sum() >= 60 // 7 - 1
+    assert np.all(psd[counts == 0] == 0)
+    assert len(index['files']) == 8
+
+def test_incremental_build_matches_full_build(tmp_path, dataset):
+    full = tmp_path / 'full'
+    assert run_ltsa(write_csv(tmp_path / 'dataset_files.csv', dataset), full, tmp_path) == 0
+    incremental = tmp_path / 'incremental'
+    # Files after, before and between the existing columns
+    for name, rows in [('late', dataset[4:7]), ('early', dataset[:2]), ('middle', dataset[2:4] + dataset[7:])]:
+        assert run_ltsa(write_csv(tmp_path / f"{name}.csv", rows), incremental, tmp_path) == 0
+    assert_same_ltsa(incremental, full)
+
+@pytest.mark.parametrize('crash_at', [1, 3, 4, 5])
+def test_rerun_after_crash_between_add_and_commit(tmp_path, dataset, crash_at):
+    full = tmp_path / 'full'
+    csv_file = write_csv(tmp_path / 'dataset_files.csv', dataset)
+    assert run_ltsa(csv_file, full, tmp_path) == 0
+    crashed = tmp_path / 'crashed'
+    assert run_ltsa(write_csv(tmp_path / 'late.csv', dataset[4:7]), crashed, tmp_path) == 0
+    # Pending files are glider 0 (new generation before the columns), 1 and 2, 3 (sharing a column with glider 4) and 7 (grown in place)
+    assert run_ltsa(csv_file, crashed, tmp_path, crash_at) == 3
+    assert run_ltsa(csv_file, crashed, tmp_path) == 0
+    assert_same_ltsa(crashed, full)
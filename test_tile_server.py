@@ -0,0 +1,62 @@
+"""
+Tests of tile_server.py, run against a server subprocess
+"""
+
+import os
+import re
+import subprocess
+import sys
+import urllib.request
+
+import pytest
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+SPECTRO_ARGS = '--nfft 512 --win_size 512 --overlap 50 --color_val_range=-90:0 --max-memory 4'
+
+
+@pytest.fixture
+def tile_server(tmp_path):
+    """Starts tile_server.py on the wav files of tmp_path and yields (process, base url)"""
+    processes = []
+
+    def start(spectro_args, tile_levels=3):
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPTS, 'tile_server.py'), str(tmp_path), '--spectro-args', spectro_args,
+                                    '--tile-levels', str(tile_levels), '--port', '0', '--threads', '1', '--no-prefetch'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        processes.append(process)
+        line = process.stdout.readline()
+        match = re.search(r'(http://[^/]+)/', line)
+        assert match, line
+        return process, match.group(1)
+
+    yield start
+    for process in processes:
+        process.kill()
+        process.wait()
+
+def get(url):
+    """Returns the body of a GET of url"""
+    with urllib.request.urlopen(url, timeout=60) as response:
+        assert response.status == 200
+        return response.read()
+
+@pytest.mark.parametrize('mode', ['', '--pyramid'])
+def test_streamed_tiles_of_files_requested_alternately(tmp_path, write_wav, tile_server, mode):
+    # The longer file PSD is still mapped when the shorter file one is streamed
+    write_wav(tmp_path / 'a.wav', 30, frequency=1000)
+    write_wav(tmp_path / 'c.wav', 5, frequency=2000, seed=1)
+    process, url = tile_server(f"{SPECTRO_ARGS} {mode}")
+
+    tiles = {}
+    for tile in ['a_1_0', 'c_1_0', 'a_2_1', 'c_2_0', 'a_4_3', 'c_4_1']:
+        tiles[tile] = get(f"{url}/{tile}.png")
+    assert process.poll() is None
+
+    # Served tiles are the ones of gen_spectro.py with the same settings
+    for name in ['a', 'c']:
+        output = tmp_path / 'reference' / name
+        output.mkdir(parents=True)
+        subprocess.run([sys.executable, os.path.join(SCRIPTS, 'gen_spectro.py'), str(tmp_path / f"{name}.wav"), str(output / f"{name}.png"),
+                        '--tile-levels', '3'] + f"{SPECTRO_ARGS} {mode}".split(), check=True, capture_output=True)
+    for tile, data in tiles.items():
+        assert data == (tmp_path / 'reference' / tile[0] / f"{tile}.png").read_bytes(), tile
@@ -0,0 +1,177 @@
+#!/bin/python3
+"""
+Compressed tar archives of spectro tiles written by gen_spectro.py --archive, with an index member for random access
+"""
+
+import argparse
+import json
+import os
+import struct
+import tarfile
+import time
+import zlib
+
+
+PARSER = argparse.ArgumentParser(description='Script that lists or extracts members of a gen_spectro tile archive without decompressing all of it')
+PARSER.add_argument('archive', help='Path to the .tgz or .tar.zst tile archive')
+PARSER.add_argument('members', nargs='*', help='Members to extract, members are listed when none are given')
+PARSER.add_argument('--output', '-o', type=str, default='.', help='Folder where members are extracted')
+
+# Archive extension of each compression
+COMPRESSIONS = {'gz': '.tgz', 'zst': '.tar.zst'}
+INDEX_MEMBER = '.tile_index.json'
+# Locator of the index member frame (magic, offset, length) stored in the last gzip member extra field or in a zstd skippable frame
+LOCATOR = struct.Struct('<4sQQ')
+LOCATOR_MAGIC = b'TIDX'
+GZIP_SUBFIELD = b'TI'
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+# Tar end of archive marker
+TAR_END = bytes(2 * tarfile.BLOCKSIZE)
+
+
+def archive_compression(path):
+    """Returns the compression of the archive at path from its extension"""
+    for compression, extension in COMPRESSIONS.items():
+        if path.endswith(extension):
+            return compression
+    raise ValueError(f"Tile archive should end with one of {list(COMPRESSIONS.values())}, not {path}")
+
+def zstandard_module():
+    """Returns the zstandard module, needed for zst archives only"""
+    try:
+        import zstandard
+    except ImportError as error:
+        raise ImportError('zst tile archives need the zstandard package (pip install zstandard)') from error
+    return zstandard
+
+def gzip_member(data, level=6, extra=b''):
+    """Returns data compressed as a single gzip member, with the optional extra field"""
+    header = struct.pack('<BBBBIBB', 0x1f, 0x8b, zlib.DEFLATED, 4 if extra else 0, 0, 0, 255)
+    if extra:
+        header += struct.pack('<H', len(extra)) + extra
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return header + compressor.compress(data) + compressor.flush() + struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+
+
+class TileArchive:
+    """Tar archive written member by member, each member being its own gzip member or zstd frame
+
+    Concatenated members make a regular .tgz or .tar.zst that tar extracts, and the index.json member
+    gives the compressed offset of every member so one can be read alone (see read_member).
+    The archive is written to a temporary file, renamed to path by close only.
+    """
+
+    def __init__(self, path, compression='gz', level=None):
+        self.path = path
+        self.compression = compression
+        self.temp_path = f"{path}.{os.getpid()}.tmp"
+        self.index = {}
+        if compression == 'gz':
+            self.level = 6 if level is None else level
+        elif compression == 'zst':
+            self.compressor = zstandard_module().ZstdCompressor(level=3 if level is None else level)
+        else:
+            raise ValueError(f"Compression should be one of {list(COMPRESSIONS)}, not {compression}")
+        self.archive_f = open(self.temp_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def compress(self, data):
+        """Returns data compressed as an independent gzip member or zstd frame"""
+        if self.compression == 'gz':
+            return gzip_member(data, self.level)
+        return self.compressor.compress(data)
+
+    def add(self, name, data):
+        """Appends the file data as member name"""
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.GNU_FORMAT)
+        padding = -len(data) % tarfile.BLOCKSIZE
+        offset = self.archive_f.tell()
+        self.archive_f.write(self.compress(header + data + bytes(padding)))
+        self.index[name] = [offset, self.archive_f.tell() - offset, len(header), len(data)]
+
+    def close(self):
+        """Appends the index member and end of archive, then moves the archive to path"""
+        index = json.dumps({'compression': self.compression, 'members': self.index}).encode()
+        self.add(INDEX_MEMBER, index)
+        locator = LOCATOR.pack(LOCATOR_MAGIC, *self.index[INDEX_MEMBER][:2])
+        if self.compression == 'gz':
+            self.archive_f.write(gzip_member(TAR_END, self.level, GZIP_SUBFIELD + struct.pack('<H', len(locator)) + locator))
+        else:
+            self.archive_f.write(self.compressor.compress(TAR_END))
+            self.archive_f.write(struct.pack('<II', ZSTD_SKIPPABLE_MAGIC, len(locator)) + locator)
+        self.archive_f.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        """Removes the unfinished archive"""
+        self.archive_f.close()
+        os.remove(self.temp_path)
+
+
+def decompress(frame, compression):
+    """Returns the decompressed gzip member or zstd frame"""
+    if compression == 'gz':
+        return zlib.decompress(frame, zlib.MAX_WBITS | 16)
+    return zstandard_module().ZstdDecompressor().decompress(frame)
+
+def read_frame(archive_f, compression, offset, length, header_length, size):
+    """Returns the data of the member whose frame is at offset in archive_f"""
+    archive_f.seek(offset)
+    member = decompress(archive_f.read(length), compression)
+    return member[header_length:header_length + size]
+
+def read_index(path):
+    """Returns the index of the tile archive at path, members names giving [offset, length, header length, size]"""
+    compression = archive_compression(path)
+    with open(path, 'rb') as archive_f:
+        archive_f.seek(0, os.SEEK_END)
+        archive_f.seek(max(0, archive_f.tell() - 4096))
+        tail = archive_f.read()
+        position = tail.rfind(LOCATOR_MAGIC)
+        if position < 0:
+            raise ValueError(f"{path} has no tile archive index")
+        _, offset, length = LOCATOR.unpack_from(tail, position)
+        # The index member frame is only read to find its header length
+        archive_f.seek(offset)
+        member = decompress(archive_f.read(length), compression)
+        info = tarfile.TarInfo.frombuf(member[:tarfile.BLOCKSIZE], tarfile.ENCODING, 'surrogateescape')
+        header_length = len(member) - info.size - (-info.size % tarfile.BLOCKSIZE)
+        return json.loads(member[header_length:header_length + info.size])
+
+def read_member(path, name, index=None):
+    """Returns the data of member name of the tile archive at path, decompressing its frame only"""
+    index = index or read_index(path)
+    with open(path, 'rb') as archive_f:
+        return read_frame(archive_f, index['compression'], *index['members'][name])
+
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    index = read_index(args.archive)
+
+    if not args.members:
+        for name, (_, length, _, size) in index['members'].items():
+            print(f"{size:10} {length:10} {name}")
+        return
+
+    for name in args.members:
+        output_file = os.path.join(args.output, name)
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        with open(output_file, 'wb') as output_f:
+            output_f.write(read_member(args.archive, name, index))
+
+if __name__ == '__main__':
+    main()
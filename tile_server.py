@@ -0,0 +1,334 @@
+#!/bin/python3
+"""
+HTTP server rendering gen_spectro.py zoom tiles of a folder of wav files on request, instead of pre-rendering every level
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shlex
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import soundfile
+
+import gen_spectro
+from psd_cache import PSDCache
+
+
+PARSER = argparse.ArgumentParser(description='Script that serves the {name}_{zoom}_{tile}.png zoom tiles of the wav files of a folder, rendered on request with gen_spectro.py settings')
+PARSER.add_argument('folder', help='Folder of the wav files, {name}.wav tiles are served as /{name}_{zoom}_{tile}.png')
+PARSER.add_argument('--spectro-args', type=str, default='--nfft 2048 --win_size 512 --overlap 90 --color_val_range=-90:0', help='gen_spectro.py arguments of the rendered tiles, --pyramid or --max-memory render tiles out of the whole file PSD')
+PARSER.add_argument('--tile-levels', '-tl', type=int, default=6, help='Number of tile levels served (default 6)')
+PARSER.add_argument('--host', type=str, default='127.0.0.1', help='Address the server listens on')
+PARSER.add_argument('--port', type=int, default=8000, help='Port the server listens on')
+PARSER.add_argument('--memory-cache', type=float, default=256, help='Size (in MB) of the in-memory LRU of rendered tiles')
+PARSER.add_argument('--disk-cache', type=str, default=None, help='Folder of the on-disk LRU of rendered tiles (default a temporary folder removed on exit)')
+PARSER.add_argument('--disk-cache-size', type=float, default=2048, help='Size limit (in MB) of the on-disk LRU of rendered tiles')
+PARSER.add_argument('--threads', type=int, default=os.cpu_count(), help='Number of threads rendering requested and prefetched tiles')
+PARSER.add_argument('--no-prefetch', action='store_true', help='Does not render the neighbours and children of requested tiles in the background')
+
+TILE_PATH = re.compile(r'^/(.+)_(\d+)_(\d+)\.png$')
+
+
+class TileCache:
+    """Bounded in-memory LRU of rendered tiles in front of a bounded on-disk LRU of their png files
+
+    Disk entries are the files of folder, their modification time being their last access like in PSDCache.
+    """
+
+    def __init__(self, memory_size, folder, disk_size):
+        self.memory_size = memory_size
+        self.folder = folder
+        self.disk_size = disk_size
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        os.makedirs(folder, exist_ok=True)
+        entries = []
+        for filename in os.listdir(folder):
+            if filename.endswith('.png'):
+                stat = os.stat(os.path.join(folder, filename))
+                entries.append((stat.st_mtime, filename, stat.st_size))
+        self.disk = OrderedDict((filename, size) for _, filename, size in sorted(entries))
+        self.disk_used = sum(self.disk.values())
+
+    def path(self, name):
+        """Returns the on-disk path of tile name"""
+        return os.path.join(self.folder, name)
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.memory or name in self.disk
+
+    def get(self, name):
+        """Returns the png data of tile name, or None when it is not cached"""
+        with self.lock:
+            if name in self.memory:
+                self.memory.move_to_end(name)
+                return self.memory[name]
+            if name not in self.disk:
+                return None
+            self.disk.move_to_end(name)
+        try:
+            with open(self.path(name), 'rb') as png_file:
+                data = png_file.read()
+            os.utime(self.path(name))
+        except OSError:
+            return None
+        self.put_memory(name, data)
+        return data
+
+    def add(self, name, temp_path):
+        """Moves the tile rendered to temp_path into the cache as name and returns its png data"""
+        with open(temp_path, 'rb') as png_file:
+            data = png_file.read()
+        os.replace(temp_path, self.path(name))
+        evicted = []
+        with self.lock:
+            self.disk_used += len(data) - self.disk.pop(name, 0)
+            self.disk[name] = len(data)
+            while self.disk_used > self.disk_size and len(self.disk) > 1:
+                old_name, size = self.disk.popitem(last=False)
+                self.disk_used -= size
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(self.path(old_name))
+            except FileNotFoundError:
+                pass
+        self.put_memory(name, data)
+        return data
+
+    def put_memory(self, name, data):
+        """Keeps the png data of tile name in memory, evicting least recently used tiles"""
+        with self.lock:
+            self.memory_used += len(data) - len(self.memory.pop(name, b''))
+            self.memory[name] = data
+            while self.memory_used > self.memory_size and len(self.memory) > 1:
+                _, old_data = self.memory.popitem(last=False)
+                self.memory_used -= len(old_data)
+
+    def forget(self, prefix, older_than):
+        """Removes the disk tiles starting with prefix modified before older_than (a timestamp)"""
+        with self.lock:
+            names = [name for name in self.disk if name.startswith(prefix)]
+        for name in names:
+            try:
+                if os.path.getmtime(self.path(name)) >= older_than:
+                    continue
+                os.remove(self.path(name))
+            except OSError:
+                pass
+            with self.lock:
+                self.disk_used -= self.disk.pop(name, 0)
+                self.memory_used -= len(self.memory.pop(name, b''))
+
+
+class AudioSlices:
+    """First channel samples of an audio file read from disk when sliced, highpass filtered like SpectroGenerator.sample_blocks"""
+
+    def __init__(self, audio_file, spectro_generator):
+        self.sound_file = soundfile.SoundFile(audio_file)
+        self.sample_blocks = spectro_generator.sample_blocks(self.sound_file)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.sample_blocks.nb_samples
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(len(self))
+        with self.lock:
+            return self.sample_blocks.read(start, stop)
+
+
+class FileTiles:
+    """Renders the tiles of a wav file with its own SpectroGenerator, in gen_tiles or gen_tiles_pyramid layout
+
+    With equalize_spectro, the level 0 tile is rendered first since it sets the normalisation of the others.
+    """
+
+    def __init__(self, audio_file, args, psd_cache, tmp_dir):
+        self.audio_file = audio_file
+        self.args = args
+        self.tmp_dir = tmp_dir
+        self.lock = threading.Lock()
+        self.ready_lock = threading.Lock()
+        self.spectro_generator = gen_spectro.make_spectro_generator(args)
+        if psd_cache is not None:
+            self.spectro_generator.psd_cache = psd_cache
+            self.spectro_generator.psd_source = {
+                'audio': psd_cache.file_hash(audio_file),
+                'butter_order': args.butter_order,
+                'butter_cutoff': gen_spectro.butter_cutoff(args) if args.butter_order else None
+            }
+        if args.butter_order:
+            self.spectro_generator.butter = (args.butter_order, gen_spectro.butter_cutoff(args))
+        self.equalize_spectro = not args.max_bgw
+        self.ready = not self.equalize_spectro
+        self.data = AudioSlices(audio_file, self.spectro_generator)
+        self.nb_samples = len(self.data)
+        self.sample_rate = self.data.sample_blocks.sample_rate
+        self.slices = {(zoom_level, tile): (level, start, end) for level, zoom_level, tile, start, end in gen_spectro.tile_slices(args.tile_levels, self.nb_samples, self.sample_rate)}
+        self.whole_psd = None
+
+    def psd(self):
+        """Returns (frequencies, spectro) of the whole file, computed once, for pyramid tiles"""
+        with self.lock:
+            if self.whole_psd is None:
+                if self.spectro_generator.max_memory:
+                    psd = self.spectro_generator.streamed_psd(self.audio_file, self.nb_samples, self.tmp_dir)
+                    _, frequencies, spectro = self.spectro_generator.psd_view(psd, self.nb_samples, self.sample_rate)
+                else:
+                    _, frequencies, spectro = self.spectro_generator.get_psd(self.data, self.sample_rate)
+                self.whole_psd = frequencies, spectro
+            return self.whole_psd
+
+    def render(self, zoom_level, tile, output_file):
+        """Renders tile of zoom_level to output_file"""
+        level, start, end = self.slices[(zoom_level, tile)]
+        main_ref = self.equalize_spectro and level == 0
+        if self.args.pyramid or self.spectro_generator.max_memory:
+            frequencies, spectro = self.psd()
+            self.spectro_generator.render_pyramid_tile(self.nb_samples, self.sample_rate, frequencies, spectro, level, zoom_level, tile, start, end, output_file, main_ref)
+        else:
+            self.spectro_generator.render_tile(self.data, self.sample_rate, level, zoom_level, tile, start, end, output_file, main_ref)
+
+
+class TileServer:
+    """Renders requested tiles with a pool of threads, each tile once, and serves them from a TileCache"""
+
+    def __init__(self, folder, args, cache, tmp_dir, threads=1, prefetch=True):
+        self.folder = folder
+        self.args = args
+        self.cache = cache
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.lock = threading.Lock()
+        self.files = {}
+        self.rendering = {}
+        self.psd_cache = PSDCache(args.psd_cache, int(args.psd_cache_size * 2**20)) if args.psd_cache else None
+        self.tmp_dir = tmp_dir
+
+    def file_tiles(self, name):
+        """Returns the FileTiles of {name}.wav, or None when it does not exist"""
+        audio_file = os.path.join(self.folder, name + '.wav')
+        with self.lock:
+            if name not in self.files:
+                if os.path.dirname(name) or not os.path.isfile(audio_file):
+                    return None
+                # Tiles rendered before the audio file last changed are stale
+                self.cache.forget(f"{name}_", os.path.getmtime(audio_file))
+                self.files[name] = FileTiles(audio_file, self.args, self.psd_cache, self.tmp_dir)
+            return self.files[name]
+
+    def tile(self, name, zoom_level, tile, prefetched=False):
+        """Returns the future png data of tile of zoom_level of {name}.wav, or None when there is no such tile"""
+        file_tiles = self.file_tiles(name)
+        if file_tiles is None or (zoom_level, tile) not in file_tiles.slices:
+            return None
+        tile_name = f"{name}_{zoom_level}_{tile}.png"
+        data = self.cache.get(tile_name)
+        if data is not None:
+            future = Future()
+            future.set_result(data)
+        else:
+            with self.lock:
+                future = self.rendering.get(tile_name)
+                if future is None:
+                    future = self.rendering[tile_name] = self.executor.submit(self.render, file_tiles, zoom_level, tile, tile_name)
+        if self.prefetch and not prefetched:
+            for neighbour in tile_neighbours(zoom_level, tile, file_tiles.args.tile_levels):
+                if f"{name}_{neighbour[0]}_{neighbour[1]}.png" not in self.cache:
+                    self.tile(name, *neighbour, prefetched=True)
+        return future
+
+    def render(self, file_tiles, zoom_level, tile, tile_name):
+        """Renders tile_name into the cache, after the level 0 tile that normalises it, and returns its png data"""
+        try:
+            if not file_tiles.ready:
+                with file_tiles.ready_lock:
+                    # The level 0 tile is rendered again after a restart even when cached, to set the normalisation
+                    if not file_tiles.ready:
+                        data = self.render_into_cache(file_tiles, 1, 0, tile_name[:-len(f"_{zoom_level}_{tile}.png")] + '_1_0.png')
+                        file_tiles.ready = True
+                        if zoom_level == 1:
+                            return data
+            return self.cache.get(tile_name) or self.render_into_cache(file_tiles, zoom_level, tile, tile_name)
+        finally:
+            with self.lock:
+                self.rendering.pop(tile_name, None)
+
+    def render_into_cache(self, file_tiles, zoom_level, tile, tile_name):
+        """Renders tile_name of file_tiles into the cache and returns its png data"""
+        temp_path = os.path.join(self.tmp_dir, f"{threading.get_ident()}.png")
+        file_tiles.render(zoom_level, tile, temp_path)
+        return self.cache.add(tile_name, temp_path)
+
+
+def tile_neighbours(zoom_level, tile, tile_levels):
+    """Returns the (zoom_level, tile) of the tiles next to tile and of its children, likely viewed after it"""
+    neighbours = [(zoom_level, neighbour) for neighbour in (tile - 1, tile + 1) if 0 <= neighbour < zoom_level]
+    if 2 * zoom_level < 2**tile_levels:
+        neighbours += [(2 * zoom_level, 2 * tile), (2 * zoom_level, 2 * tile + 1)]
+    return neighbours
+
+def settings_folder(args):
+    """Returns the disk cache subfolder of the tiles rendered with parsed gen_spectro.py args"""
+    settings = {name: getattr(args, name) for name in gen_spectro.MANIFEST_ARGS}
+    settings['streamed'] = bool(args.max_memory)
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+def make_handler(tile_server):
+    """Returns the request handler class serving the tiles of tile_server"""
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            match = TILE_PATH.match(self.path.split('?')[0])
+            future = tile_server.tile(match.group(1), int(match.group(2)), int(match.group(3))) if match else None
+            if future is None:
+                self.send_error(404, 'No such tile')
+                return
+            try:
+                data = future.result()
+            except Exception:
+                traceback.print_exc()
+                self.send_error(500, 'Tile rendering failed')
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return TileHandler
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    spectro_args = gen_spectro.PARSER.parse_args(['server.wav'] + shlex.split(args.spectro_args) + ['--tile-levels', str(args.tile_levels)])
+    if spectro_args.renderer != 'raster':
+        raise ValueError('Tiles are rendered concurrently, the tile server needs the raster renderer')
+    if spectro_args.params:
+        raise ValueError('The tile server renders a single parameter set, run one server per --params set')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_folder = os.path.join(args.disk_cache or tmp_dir, settings_folder(spectro_args))
+        cache = TileCache(int(args.memory_cache * 2**20), cache_folder, int(args.disk_cache_size * 2**20))
+        tile_server = TileServer(args.folder, spectro_args, cache, tmp_dir, args.threads, not args.no_prefetch)
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(tile_server))
+        print(f"Serving tiles of {args.folder} on http://{args.host}:{server.server_port}/{{name}}_{{zoom}}_{{tile}}.png", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            tile_server.executor.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == '__main__':
+    main()
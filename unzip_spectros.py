@@ -1,17 +1,157 @@
-# Script meant to be used in Docker/volumes/annotator_resources/png to unzip spectros tgz
+#!/bin/python3
+"""
+Script meant to be used in Docker/volumes/annotator_resources/png to unzip spectros tgz
 
-import os, json
+Each archive is extracted to a folder named after the dataset_files id of its wav file.
+"""
 
-file_line = ""
-with open("../../db_seeds/init.js", "r") as f:
-    file_line = [line for line in f.readlines() if "filename" in line][0]
+import argparse
+import csv
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-file_to_id = {record["filename"]:str(record["id"]) for record in json.loads(file_line.replace("'", '"'))}
+from tile_archive import COMPRESSIONS, INDEX_MEMBER, archive_compression, zstandard_module
 
-tgzs = [filename for filename in os.listdir() if filename.endswith(".tgz")]
 
-for tgz in tgzs:
-    target = file_to_id[tgz[:-3] + "wav"]
-    os.mkdir(target)
-    os.system(f"tar zxf {tgz} -C {target}")
-    os.remove(tgz)
+PARSER = argparse.ArgumentParser(description='Script that extracts spectro archives to folders named after the dataset_files id of their wav file')
+PARSER.add_argument('folder', nargs='?', default='.', help='Folder of the .tgz or .tar.zst spectro archives (default current folder)')
+PARSER.add_argument('--ids', type=str, default='../../db_seeds/dataset_file_ids.json', help='dataset_files ids by filename, the JSON written by gen_seed.py or the dataset_files.csv of its --bulk seed_csv folder')
+PARSER.add_argument('--tile-levels', '-tl', type=int, default=6, help='Number of tile levels every spectro folder of an archive should have (default 6, like gen_spectros.sh)')
+PARSER.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of archives extracted in parallel')
+PARSER.add_argument('--keep', action='store_true', help='Keeps archives once extracted')
+
+TILE_NAME = re.compile(r'_(\d+)_(\d+)\.png$')
+
+
+def load_file_ids(ids_file):
+    """Returns the dataset_files ids by filename of a gen_seed.py JSON ids file or dataset_files.csv file"""
+    with open(ids_file, 'r') as ids_f:
+        if ids_file.endswith('.csv'):
+            return {row['filename']: int(row['id']) for row in csv.DictReader(ids_f)}
+        return json.load(ids_f)
+
+def archive_wav(archive_file):
+    """Returns the wav filename an archive was made from"""
+    name = os.path.basename(archive_file)
+    return name[:-len(COMPRESSIONS[archive_compression(name)])] + '.wav'
+
+def open_tar(archive_f, compression):
+    """Returns the tarfile reading the open archive_f sequentially"""
+    if compression == 'gz':
+        # GzipFile reads the gzip members of gen_spectro --archive one after the other
+        return tarfile.open(fileobj=archive_f, mode='r:gz')
+    reader = zstandard_module().ZstdDecompressor().stream_reader(archive_f, read_across_frames=True)
+    return tarfile.open(fileobj=reader, mode='r|')
+
+def check_pyramid(tile_sizes, tile_levels):
+    """Raises a ValueError unless every folder of tile_sizes pngs holds the tiles of tile_levels levels"""
+    folders = {}
+    for name in tile_sizes:
+        if name.endswith('.png'):
+            folders.setdefault(os.path.dirname(name), []).append(os.path.basename(name))
+    if not folders:
+        raise ValueError('Archive has no png tiles')
+
+    expected = {(2**level, tile) for level in range(tile_levels) for tile in range(2**level)}
+    for folder, names in folders.items():
+        if tile_levels == 1:
+            tiles = {(1, 0)} if len(names) == 1 else set()
+        else:
+            tiles = {tuple(int(group) for group in TILE_NAME.search(name).groups()) for name in names if TILE_NAME.search(name)}
+        if len(names) != len(expected) or tiles != expected:
+            raise ValueError(f"Folder '{folder or '.'}' has {len(names)} tiles where {tile_levels} levels make {len(expected)}")
+
+def extract_archive(archive_file, target, tile_levels, keep=False):
+    """Extracts archive_file to the target folder, streaming members to disk, and returns the number of extracted files
+
+    Members go to a temporary folder renamed to target once they are all written and check out against the
+    archive index (when it has one) and the expected tile pyramid. archive_file is then removed unless keep.
+    """
+    if os.path.exists(target):
+        raise FileExistsError(f"{target} already exists")
+    temp_target = f"{target}.part"
+    shutil.rmtree(temp_target, ignore_errors=True)
+    os.makedirs(temp_target)
+    try:
+        index = None
+        file_sizes = {}
+        with open(archive_file, 'rb') as archive_f, open_tar(archive_f, archive_compression(archive_file)) as tar:
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+                    raise ValueError(f"Member {member.name} is outside of the archive folder")
+                if member.isdir():
+                    os.makedirs(os.path.join(temp_target, name), exist_ok=True)
+                    continue
+                if not member.isfile():
+                    raise ValueError(f"Member {member.name} is not a regular file")
+                if name == INDEX_MEMBER:
+                    index = json.load(tar.extractfile(member))
+                    continue
+                output_file = os.path.join(temp_target, name)
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                with tar.extractfile(member) as member_f, open(output_file, 'wb') as output_f:
+                    shutil.copyfileobj(member_f, output_f, 2**20)
+                file_sizes[name] = member.size
+
+        if index is not None:
+            index_sizes = {name: size for name, (_, _, _, size) in index['members'].items() if name != INDEX_MEMBER}
+            if index_sizes != file_sizes:
+                raise ValueError('Extracted members differ from the archive index')
+        check_pyramid(file_sizes, tile_levels)
+        os.rename(temp_target, target)
+    except BaseException:
+        shutil.rmtree(temp_target, ignore_errors=True)
+        raise
+
+    if not keep:
+        os.remove(archive_file)
+    return len(file_sizes)
+
+def extract_job(archive_file, target, tile_levels, keep):
+    """Worker function extracting an archive, returns the error traceback or None with the number of extracted files"""
+    try:
+        return None, extract_archive(archive_file, target, tile_levels, keep)
+    except Exception:
+        return traceback.format_exc(), 0
+
+def main():
+    """Main script function"""
+    args = PARSER.parse_args()
+    file_ids = load_file_ids(args.ids)
+
+    extensions = tuple(COMPRESSIONS.values())
+    archives = sorted(filename for filename in os.listdir(args.folder) if filename.endswith(extensions))
+    failures = {}
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = {}
+        for archive in archives:
+            wav = archive_wav(archive)
+            if wav not in file_ids:
+                failures[archive] = f"No dataset_files id for {wav} in {args.ids}"
+                print(f"FAILED {archive}: {failures[archive]}")
+                continue
+            target = os.path.join(args.folder, str(file_ids[wav]))
+            futures[executor.submit(extract_job, os.path.join(args.folder, archive), target, args.tile_levels, args.keep)] = (archive, target)
+
+        for future in as_completed(futures):
+            archive, target = futures[future]
+            error, nb_files = future.result()
+            if error:
+                failures[archive] = error
+                print(f"FAILED {archive}:\n{error}", flush=True)
+            else:
+                print(f"Extracted {nb_files} files of {archive} to {target}", flush=True)
+
+    print(f"Extracted {len(archives) - len(failures)}/{len(archives)} archives successfully")
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()